@@ -0,0 +1,175 @@
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from agent.environment.ai2thor_file import \
+    THORDiscreteEnvironment as THORDiscreteEnvironmentFile
+from agent.method.aop import AOP
+from agent.method.gcn import GCN
+from agent.method.similarity_grid import SimilarityGrid
+from agent.method.target_driven import TargetDriven
+from agent.network import (SceneSpecificNetwork, SharedNetwork, create_scene_network,
+                           select_scene)
+from agent.training import TrainingSaver
+from agent.utils import find_restore_point, inference_mode
+
+
+def create_method_class(method):
+    if method == 'word2vec' or method == 'word2vec_nosimi' or \
+       method == 'word2vec_noconv' or method == 'word2vec_notarget' or \
+       method == 'gcn' or method == 'aop_we' or method == 'word2vec_notarget_lstm' or \
+       method == 'word2vec_notarget_lstm_2layer' or method == 'word2vec_notarget_lstm_3layer' or \
+       method == 'word2vec_notarget_rnn' or method == 'word2vec_notarget_gru':
+        return SimilarityGrid(method)
+    elif method == 'aop' or method == 'aop_we':
+        return AOP(method)
+    elif method == 'target_driven':
+        return TargetDriven(method)
+    elif method == 'gcn':
+        return GCN(method)
+    raise Exception('Please choose a method')
+
+
+def load_network(config, device=torch.device('cpu')):
+    """Network of the latest checkpoint of config['checkpoint_path'] in eval mode
+
+    The rank of the observation layer is read from the checkpoint when
+    config has no observation_rank (see compress_checkpoint.py), as well as
+    the scenes of per-scene heads (see MultiSceneNetwork).
+    """
+    checkpoint_path = config.get(
+        'checkpoint_path', 'model/checkpoint-{checkpoint}.pth')
+    (base_name, restore_point) = find_restore_point(checkpoint_path)
+    print('Restoring from checkpoint', restore_point)
+    state = torch.load(open(os.path.join(os.path.dirname(
+        os.path.abspath(checkpoint_path)), base_name), 'rb'), map_location='cpu')
+    observation_rank = config.get(
+        'observation_rank', state.get('config', dict()).get('observation_rank'))
+
+    shared_net = SharedNetwork(config['method'], config.get('mask_size', 5),
+                               observation_rank=observation_rank)
+    scene_net = create_scene_network(config['action_size'], state.get('navigation/scenes'))
+    if config.get('observation_cache', False):
+        shared_net.enable_observation_cache()
+    TrainingSaver(shared_net, scene_net, None, dict(config)).restore(state)
+    network = nn.Sequential(shared_net, scene_net).to(device)
+    network.eval()
+    return network
+
+
+def create_env(config, scene_scope, task_scope, **kwargs):
+    """Environment of a task with the same arguments as Evaluation"""
+    env_kwargs = dict(scene_name=scene_scope,
+                      method=config['method'],
+                      reward=config['reward'],
+                      h5_file_path=(lambda scene: config.get(
+                          "h5_file_path").replace('{scene}', scene)),
+                      terminal_state=task_scope,
+                      action_size=config['action_size'],
+                      mask_size=config.get('mask_size', 5))
+    env_kwargs.update(kwargs)
+    return THORDiscreteEnvironmentFile(**env_kwargs)
+
+
+def _policy(config, method_class, env, network, device):
+    with inference_mode():
+        policy, _, _ = method_class.forward_policy(env, device, network)
+        if config.get('action_mask', False):
+            valid_actions = torch.from_numpy(env.valid_actions())
+            policy = SceneSpecificNetwork.mask_policy(policy, valid_actions.to(device))
+        return F.softmax(policy, dim=0).cpu().numpy().astype(np.float64)
+
+
+def compare_policies(config, reference, candidate, num_episode=20, seed=0,
+                     max_step=200, device=torch.device('cpu')):
+    """Seeded evaluation of a candidate against a reference setup
+
+    Each setup is a (network, env_kwargs) pair, env_kwargs are added to the
+    environment arguments of every task of config['task_list'].
+
+    The same start states and the same sampling seeds are used for both
+    setups: success rate, SPL and episode length are measured on independent
+    runs, the policy fidelity (agreement of the most probable action and KL
+    divergence) is measured in lockstep on the states visited by the
+    reference. The latency is the mean time of a policy evaluation (env
+    input, forward and softmax) in milliseconds.
+
+    Returns:
+        dict -- reference and candidate metrics, action_agreement and kl
+    """
+    method_class = create_method_class(config['method'])
+    runs = {'reference': [], 'candidate': []}
+    latency = {'reference': [], 'candidate': []}
+    agreement = []
+    kl = []
+    for scene_scope, items in config['task_list'].items():
+        for task_scope in items:
+            envs = {name: create_env(config, scene_scope, task_scope, **setup[1])
+                    for name, setup in [('reference', reference), ('candidate', candidate)]}
+            networks = {'reference': reference[0], 'candidate': candidate[0]}
+            for network in networks.values():
+                select_scene(network, scene_scope, fallback=True)
+            for episode in range(num_episode):
+                # Independent runs from the same start state with the same seed
+                for name, env in envs.items():
+                    random.seed(seed + episode)
+                    if not env.reset():
+                        break
+                    generator = np.random.RandomState(seed + episode)
+                    start = env.current_state_id
+                    for t in range(max_step):
+                        start_time = time.perf_counter()
+                        policy = _policy(config, method_class, env, networks[name], device)
+                        latency[name].append(time.perf_counter() - start_time)
+                        env.step(generator.choice(len(policy), p=policy / policy.sum()))
+                        env.reward
+                        if env.terminal:
+                            break
+                    shortest = env.shortest_path_terminal(start)
+                    runs[name].append((env.success, t + 1, shortest / (t + 1)))
+                else:
+                    # Lockstep on the trajectory of the reference
+                    random.seed(seed + episode)
+                    envs['reference'].reset()
+                    envs['candidate'].current_state_id = envs['reference'].current_state_id
+                    envs['candidate'].reset(set_state=False)
+                    generator = np.random.RandomState(seed + episode)
+                    for t in range(max_step):
+                        p = _policy(config, method_class, envs['reference'], networks['reference'], device)
+                        q = _policy(config, method_class, envs['candidate'], networks['candidate'], device)
+                        agreement.append(np.argmax(p) == np.argmax(q))
+                        kl.append(np.sum(p * (np.log(p + 1e-12) - np.log(q + 1e-12))))
+                        action = generator.choice(len(p), p=p / p.sum())
+                        for env in envs.values():
+                            env.step(action)
+                            env.reward
+                        if envs['reference'].terminal:
+                            break
+            for env in envs.values():
+                env.stop()
+
+    results = dict()
+    for name, run in runs.items():
+        run = np.array(run, dtype=np.float64).reshape(-1, 3)
+        results[name] = {'success': 100.0 * np.mean(run[:, 0]),
+                         'length': np.mean(run[:, 1]),
+                         'spl': np.mean(run[:, 0] * run[:, 2]),
+                         'latency': 1000.0 * np.mean(latency[name])}
+    results['action_agreement'] = 100.0 * np.mean(agreement)
+    results['kl'] = np.mean(kl)
+    return results
+
+
+def print_comparison(results, name='candidate'):
+    for setup in ['reference', 'candidate']:
+        print('%s: %.2f%% success | %.3f spl | %.2f steps | %.3f ms/step' % (
+            setup if setup == 'reference' else name,
+            results[setup]['success'], results[setup]['spl'], results[setup]['length'],
+            results[setup]['latency']))
+    print('action agreement: %.2f%% | mean KL: %.5f' % (
+        results['action_agreement'], results['kl']))
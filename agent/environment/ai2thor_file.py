@@ -1,13 +1,244 @@
 # -*- coding: utf-8 -*-
 import json
 import random
+from collections import OrderedDict, namedtuple
 
-import torch
 import h5py
 import numpy as np
-from scipy import spatial
+from scipy import sparse
 
 from agent.environment.environment import Environment
+from agent.environment.frame_history import FrameHistory
+from agent.environment.pose_index import PoseIndex
+from agent.environment.prefetch import StatePrefetcher
+from agent.environment.scene_store import dequantize_features, load_scene_arrays
+
+
+def goal_distance(transition_graph, goal_mask):
+    """Distance (in number of step) from every state to the closest goal state
+
+    Multi-source breadth first search over the transition graph. The graph is
+    used as undirected, like the networkx graph used to compute
+    shortest_path_distance in create_dataset.py.
+
+    Arguments:
+        transition_graph {np.ndarray} -- [n_states, n_actions] destination state id, -1 for collision
+        goal_mask {np.ndarray} -- [n_states] boolean, True for goal states
+
+    Returns:
+        np.ndarray -- [n_states] distance to the closest goal, -1 if no goal is reachable
+    """
+    n_states = transition_graph.shape[0]
+    src, action = np.nonzero(transition_graph != -1)
+    dst = transition_graph[src, action]
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(src), dtype=np.int32), (src, dst)), shape=(n_states, n_states))
+    adjacency = adjacency + adjacency.T
+
+    distance = np.full(n_states, -1, dtype=np.int64)
+    frontier = np.asarray(goal_mask, dtype=bool)
+    distance[frontier] = 0
+    step = 0
+    while frontier.any():
+        step = step + 1
+        frontier = (adjacency.dot(frontier.astype(np.int32)) > 0) & (distance == -1)
+        distance[frontier] = step
+    return distance
+
+
+def bbox_grid(n_states, frame_shape, grid_shape, bbox_state, bbox_coord, bbox_value):
+    """Downsample bounding box centers of every state to a grid
+
+    Vectorized equivalent of THORDiscreteEnvironment._downsample_bbox over all
+    the boxes of a scene, each grid cell keeps the maximum value of its boxes.
+
+    Arguments:
+        n_states {int} -- Number of state in the scene
+        frame_shape {tuple} -- (h, w) of the observation
+        grid_shape {tuple} -- Shape of the output grid
+        bbox_state {np.ndarray} -- [n_bbox] state id of each box
+        bbox_coord {np.ndarray} -- [n_bbox, 4] (x1, y1, x2, y2) of each box
+        bbox_value {np.ndarray} -- [n_bbox] value of each box
+
+    Returns:
+        np.ndarray -- [n_states, *grid_shape] grid of every state
+    """
+    h, w = frame_shape
+    out_h, out_w = grid_shape
+    # Between 0 and output_shape
+    ratio_h = (out_h - 1) / h
+    ratio_w = (out_w - 1) / w
+
+    x = (bbox_coord[:, 0] + bbox_coord[:, 2]) / 2
+    y = (bbox_coord[:, 1] + bbox_coord[:, 3]) / 2
+    out_x = (x * ratio_w).astype(np.int64)
+    out_y = (y * ratio_h).astype(np.int64)
+
+    output = np.zeros((n_states, out_h, out_w), dtype=np.float32)
+    # fmax ignores nan similarity (object without word embedding) like max() did
+    np.fmax.at(output, (bbox_state, out_x, out_y),
+               np.asarray(bbox_value, dtype=np.float32))
+    return output
+
+
+def cosine_similarity(vectors, target):
+    """1 - cosine distance between every row of vectors and target"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64).reshape(-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance = 1.0 - vectors.dot(target) / np.sqrt(
+            np.sum(vectors * vectors, axis=1) * target.dot(target))
+    return 1 - np.clip(distance, 0.0, 2.0)
+
+
+def start_pool(rotations, goal_distance):
+    """Ids of the states an episode can start from
+
+    A start state has a zero z rotation (camera horizon), can reach a goal
+    state and is not already a goal state.
+    """
+    return np.flatnonzero((rotations[:, 2] == 0) & (goal_distance > 0))
+
+
+def start_pool_key(scene_name, terminal_state, reward):
+    """Key identifying the start pool of a (scene, target, reward) task"""
+    key = [scene_name, reward, terminal_state['object']]
+    if 'position' in terminal_state:
+        key.extend(str(v) for v in terminal_state['position'].values())
+    return '|'.join(key)
+
+
+# Complete state of an episode, see THORDiscreteEnvironment.snapshot
+EpisodeSnapshot = namedtuple('EpisodeSnapshot', [
+    'current_state_id', 'start_state_id', 'history', 'time', 'bbox_area',
+    'max_bbox_area', 'terminal', 'success', 'collided', 'last_action',
+    'hidden_state'])
+
+
+class THORScene:
+    """Data of a scene shared by the environments of all its targets
+
+    Holds the opened h5 file, the scene arrays (shared through a SceneStore if
+    available) and the tables which do not depend on the target.
+    """
+
+    def __init__(self, scene_name='FloorPlan1', h5_file_path=None, scene_store=None,
+                 streaming=False, prefetch_depth=2, prefetch_capacity=2048,
+                 feature_dtype='float32'):
+        """THORScene constructor
+
+        Keyword Arguments:
+            scene_name {str} -- Name of the world (default: {'FloorPlan1'})
+            h5_file_path {str or callable} -- Path to precomputed world (default: {None})
+            scene_store {SceneStore} -- Store holding already loaded scene arrays (default: {None})
+            streaming {bool} -- Read resnet features from disk through a StatePrefetcher (default: {False})
+            prefetch_depth {int} -- Number of action to look ahead when streaming (default: {2})
+            prefetch_capacity {int} -- Number of state kept in memory when streaming (default: {2048})
+            feature_dtype {str} -- Type of the resnet features in memory, see quantize_features (default: {'float32'})
+        """
+        # Load dataset name for this scene
+        if h5_file_path is None:
+            h5_file_path = f"/app/data/{scene_name}.h5"
+        elif callable(h5_file_path):
+            h5_file_path = h5_file_path(scene_name)
+
+        self.name = scene_name
+
+        # Load dataset
+        self.h5_file = h5py.File(h5_file_path, 'r')
+
+        # Attach to shared scene arrays if available, otherwise read them
+        if scene_store is not None and scene_name in scene_store:
+            self.arrays = scene_store.get(scene_name)
+        else:
+            self.arrays = load_scene_arrays(self.h5_file, not streaming, feature_dtype)
+
+        # Background reads of the neighborhood of the agent
+        self.prefetcher = None
+        if streaming:
+            self.prefetcher = StatePrefetcher(self.h5_file, self.arrays['graph'],
+                                              prefetch_depth, prefetch_capacity)
+
+        # Load object id dict
+        self.object_ids = json.loads(self.h5_file.attrs['object_ids'])
+
+        # Index from quantized pose to state id
+        self.pose_index = PoseIndex(self.arrays['pose_key'])
+
+        # (h, w) of the observation, read from the dataset shape
+        self.frame_shape = self.h5_file['observation'].shape[1:3]
+
+        # Environments of the targets of this scene, see THORSceneCache
+        self.views = dict()
+
+    def close(self):
+        self.views.clear()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.h5_file.close()
+
+
+class THORSceneCache:
+    """Environments of a list of (scene, target) tasks created on first use
+
+    Environments of the same scene share a THORScene. At most max_open_scenes
+    scenes are kept open, the least recently used one is closed together with
+    the environments of its targets.
+    """
+
+    def __init__(self, tasks, max_open_scenes=8, scene_store=None, **kwargs):
+        """THORSceneCache constructor
+
+        Arguments:
+            tasks {list} -- (scene_name, terminal_state) of every task
+
+        Keyword Arguments:
+            max_open_scenes {int} -- Maximum number of opened scene (default: {8})
+            scene_store {SceneStore} -- Store holding already loaded scene arrays (default: {None})
+            kwargs -- THORDiscreteEnvironment arguments common to every task
+        """
+        self.tasks = tasks
+        self.max_open_scenes = max_open_scenes
+        self.scene_store = scene_store
+        self.kwargs = kwargs
+        self.scenes = OrderedDict()
+
+    def get_scene(self, scene_name):
+        if scene_name in self.scenes:
+            self.scenes.move_to_end(scene_name)
+        else:
+            if len(self.scenes) >= self.max_open_scenes:
+                _, scene = self.scenes.popitem(last=False)
+                scene.close()
+            self.scenes[scene_name] = THORScene(
+                scene_name, self.kwargs.get('h5_file_path'), self.scene_store,
+                self.kwargs.get('streaming', False),
+                self.kwargs.get('prefetch_depth', 2),
+                self.kwargs.get('prefetch_capacity', 2048),
+                self.kwargs.get('feature_dtype', 'float32'))
+        return self.scenes[scene_name]
+
+    def __getitem__(self, idx):
+        """Environment of task idx, created and reset on first use"""
+        scene_name, terminal_state = self.tasks[idx]
+        scene = self.get_scene(scene_name)
+        if idx not in scene.views:
+            env = THORDiscreteEnvironment(scene_name=scene_name,
+                                          terminal_state=terminal_state,
+                                          scene_store=self.scene_store,
+                                          thor_scene=scene,
+                                          **self.kwargs)
+            env.reset()
+            scene.views[idx] = env
+        return scene.views[idx]
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def stop(self):
+        for scene in self.scenes.values():
+            scene.close()
+        self.scenes.clear()
 
 
 class THORDiscreteEnvironment(Environment):
@@ -27,6 +258,12 @@ class THORDiscreteEnvironment(Environment):
                  we_method=None,
                  action_size: int = 4,
                  mask_size: int = 5,
+                 scene_store=None,
+                 thor_scene=None,
+                 streaming=False,
+                 prefetch_depth: int = 2,
+                 prefetch_capacity: int = 2048,
+                 feature_dtype='float32',
                  **kwargs):
         """THORDiscreteEnvironment constructor, it represent a world where an agent evolves
 
@@ -36,22 +273,31 @@ class THORDiscreteEnvironment(Environment):
             history_length {int} -- Number of frame to stack so the network take in account previous observations (default: {4})
             terminal_state_id {int} -- Terminal position represented by an ID (default: {0})
             h5_file_path {[type]} -- Path to precomputed world (default: {None})
+            scene_store {SceneStore} -- Store holding already loaded scene arrays (default: {None})
+            thor_scene {THORScene} -- Already opened scene, owned by the caller (default: {None})
+            streaming {bool} -- Read resnet features, bbox and observation from disk through a prefetcher (default: {False})
+            prefetch_depth {int} -- Number of action to look ahead when streaming (default: {2})
+            prefetch_capacity {int} -- Number of state kept in memory when streaming (default: {2048})
+            feature_dtype {str} -- Type of the resnet features in memory: float32, float16 or int8 (default: {'float32'})
         """
         super(THORDiscreteEnvironment, self).__init__()
 
-        # Load dataset name for this scene
-        if h5_file_path is None:
-            h5_file_path = f"/app/data/{scene_name}.h5"
-        elif callable(h5_file_path):
-            h5_file_path = h5_file_path(scene_name)
+        # Open the scene unless it is shared with other targets
+        self.owns_scene = thor_scene is None
+        if thor_scene is None:
+            thor_scene = THORScene(scene_name, h5_file_path, scene_store,
+                                   streaming, prefetch_depth, prefetch_capacity,
+                                   feature_dtype)
+        self.thor_scene = thor_scene
 
         self.scene = scene_name
 
         # Store terminal state
         self.terminal_state = terminal_state
 
-        # Load dataset
-        self.h5_file = h5py.File(h5_file_path, 'r')
+        # Dataset and scene arrays
+        self.h5_file = thor_scene.h5_file
+        scene_arrays = thor_scene.arrays
 
         # Number of resnet feature per location (1)
         self.n_feat_per_location = n_feat_per_location
@@ -59,24 +305,55 @@ class THORDiscreteEnvironment(Environment):
         # Number of stacked frame
         self.history_length = history_length
 
-        self.locations = self.h5_file['location'][()]
-        self.rotations = self.h5_file['rotation'][()]
+        self.locations = scene_arrays['location']
+        self.rotations = scene_arrays['rotation']
         self.n_locations = self.locations.shape[0]
 
+        # Index from quantized pose to state id
+        self.pose_index = thor_scene.pose_index
+
         # State action graph
-        self.transition_graph = self.h5_file['graph'][()]
+        self.transition_graph = scene_arrays['graph']
+
+        # Resnet feature of every state, read through the prefetcher when streaming
+        self.prefetcher = thor_scene.prefetcher
+        if self.prefetcher is None:
+            self.resnet_feature = scene_arrays['resnet_feature']
+            feature_dataset = self.resnet_feature
+        else:
+            self.resnet_feature = None
+            feature_dataset = self.h5_file['resnet_feature']
+
+        # Precomputed resnet50 scores of every state, None if the dataset has none
+        self.resnet_score = scene_arrays.get('resnet_score')
+
+        # Scale and offset of int8 features, None otherwise
+        self.feature_scale = scene_arrays.get('resnet_feature_scale')
+        self.feature_offset = scene_arrays.get('resnet_feature_offset')
+
+        # Stacked frames given as input to the network, compressed features
+        # are upcast to float32 when they enter the history
+        self.history = FrameHistory(feature_dataset.shape[-1],
+                                    self.history_length,
+                                    dtype=np.result_type(feature_dataset.dtype, np.float32))
 
         # Number of possible action
         self.action_size = action_size
 
+        # Bitmask of the valid actions of every state, Done is always valid
+        self.action_mask = scene_arrays['action_mask']
+        if 'Done' in self.acts[:self.action_size]:
+            self.action_mask = self.action_mask | np.uint16(1 << self.acts.index('Done'))
+        self._action_bits = np.left_shift(1, np.arange(self.action_size)).astype(np.uint16)
+
         # Type of method used (word2vec, aop or target_driven)
         self.method = method
 
         # Type of reward fun (bbox or step)
         self.reward_fun = reward
 
-        # Load object id dict
-        self.object_ids = json.loads(self.h5_file.attrs['object_ids'])
+        # Object id dict
+        self.object_ids = thor_scene.object_ids
 
         # Load object resnet feature
         object_feature = self.h5_file['object_feature']
@@ -93,13 +370,36 @@ class THORDiscreteEnvironment(Environment):
         # Load shortest path distance between state
         self.shortest_path_distance = self.h5_file['shortest_path_distance']
 
-        # Load object visibility
-        self.object_visibility = [json.loads(j) for j in
-                                  self.h5_file['object_visibility']]
+        # Load object visibility (boolean matrix [state_id, object_id])
+        self.object_visibility = scene_arrays['object_visibility']
 
         # Save bbox method (None is groundtruth, yolo is yolo bbox)
         self.bbox_method = bbox_method
 
+        # Object id of the target, None if the object is unknown
+        self.target_object_id = self.object_ids.get(
+            self.terminal_state['object'])
+
+        # Flattened bounding boxes of every state
+        bbox_name = 'bbox' if self.bbox_method is None else 'yolo_bbox'
+        self.bbox_state = scene_arrays.get(bbox_name + '_state')
+        self.bbox_object = scene_arrays.get(bbox_name + '_object')
+        self.bbox_coord = scene_arrays.get(bbox_name + '_coord')
+
+        # Max bounding box area of the target in every state
+        if self.target_object_id is None:
+            self.target_bbox_area = np.zeros(self.n_locations)
+        else:
+            self.target_bbox_area = scene_arrays[bbox_name + '_area'][:, self.target_object_id]
+
+        # (h, w) of the observation
+        self.frame_shape = thor_scene.frame_shape
+        self.frame_area = self.frame_shape[0] * self.frame_shape[1]
+
+        # Grids of every state, computed on first use
+        self._similarity_grid = None
+        self._target_grid = None
+
         self.bbox_area = 0
         self.max_bbox_area = 0
 
@@ -121,11 +421,32 @@ class THORDiscreteEnvironment(Environment):
             pass
 
         else:
-            terminal_pos = list(self.terminal_state['position'].values())
-            for term_id, loc in enumerate(self.locations):
-                if np.array_equal(loc, terminal_pos):
-                    self.terminal_id = term_id
-                    break
+            # First state at the terminal position (any rotation)
+            terminal_id = self.get_state_id(
+                {'position': self.terminal_state['position']})
+            if terminal_id is not None:
+                self.terminal_id = terminal_id
+
+        # Goal states of the target and distance to the closest one
+        self.goal_mask = np.zeros(self.n_locations, dtype=bool)
+        if self.reward_fun == 'soft_goal' or self.reward_fun == 'env_goal':
+            if self.target_object_id is not None:
+                self.goal_mask = self.object_visibility[:, self.target_object_id].copy()
+        elif self.terminal_id != -1:
+            self.goal_mask[self.terminal_id] = True
+        self.goal_distance = goal_distance(self.transition_graph, self.goal_mask)
+
+        # Pool of valid start states, shared through the scene store if available
+        pool_key = start_pool_key(self.scene, self.terminal_state, self.reward_fun)
+        if scene_store is not None and scene_store.has_start_pool(pool_key):
+            self.start_pool = scene_store.get_start_pool(pool_key)
+        else:
+            self.start_pool = start_pool(self.rotations, self.goal_distance)
+            if scene_store is not None:
+                scene_store.add_start_pool(pool_key, self.start_pool)
+        if len(self.start_pool) == 0:
+            print(self.scene, 'Did not find accessible state for',
+                  self.terminal_state['object'])
 
         # LAST instruction
         if self.method == 'word2vec' or self.method == 'word2vec_nosimi' or \
@@ -140,60 +461,101 @@ class THORDiscreteEnvironment(Environment):
 
         elif self.method == 'target_driven':
             # LAST instruction
-            terminal_id = None
-            for i, loc in enumerate(self.locations):
-                if np.array_equal(loc, list(self.terminal_state['position'].values())):
-                    if np.array_equal(self.rotations[i], list(self.terminal_state['rotation'].values())):
-                        terminal_id = i
-                        break
+            terminal_id = self.get_state_id(self.terminal_state)
             self.s_target = self._tiled_state(terminal_id)
         elif self.method == "random":
             pass
         else:
             raise Exception('Please choose a method')
 
+        # Target tensor of each device, the target is the same for every episode
+        self._target_tensors = dict()
+
         self.mask_size = mask_size
 
     def reset(self, set_state=True):
         # randomize initial state
         if set_state:
-            ks = np.arange(0, self.n_locations)
-            random.shuffle(ks)
-            k_set = False
-            k_final = None
-            while not k_set:
-                for k in ks:
-                    # Assure that Z value is 0
-                    if self.rotations[k][2] == 0:
-                        # Assure that shortest path is higher than 0 (not starting in final state)
-                        if self.accessible_terminal(k) and self.shortest_path_terminal(k) > 0:
-                            k_set = True
-                            k_final = k
-                            break
-                if not k_set:
-                    print(self.scene, 'Did not find accessible state for',
-                          self.terminal_state['object'])
-                    return False
+            # Target not reachable, already reported at construction
+            if len(self.start_pool) == 0:
+                return False
+            k_final = self.start_pool[random.randrange(len(self.start_pool))]
             # reset parameters
             self.current_state_id = k_final
             self.start_state_id = k_final
+        self._prefetch()
         if self.method != "random":
-            self.s_t = self._tiled_state(self.current_state_id)
+            self.history.fill(*self._get_frame(self.current_state_id))
         self.collided = False
         self.terminal = False
         self.bbox_area = 0
         self.max_bbox_area = 0
         self.time = 0
         self.success = False
+        self.hidden_state = self._initial_hidden_state()
+        return True
+
+    def _initial_hidden_state(self):
+        # torch is only imported by the methods rendering tensors so that
+        # numpy-only processes (see agent/numpy_policy.py) do not load it
         if self.method == 'word2vec_notarget_lstm_2layer':
-            self.hidden_state = (torch.zeros(2, 1, 512), torch.zeros(2, 1, 512))
+            import torch
+            return (torch.zeros(2, 1, 512), torch.zeros(2, 1, 512))
         elif self.method == 'word2vec_notarget_lstm_3layer':
-            self.hidden_state = (torch.zeros(3, 1, 512), torch.zeros(3, 1, 512))
+            import torch
+            return (torch.zeros(3, 1, 512), torch.zeros(3, 1, 512))
         elif self.method == 'word2vec_notarget_lstm':
-            self.hidden_state = (torch.zeros(1, 1, 512), torch.zeros(1, 1, 512))
-        else:
-            self.hidden_state = torch.zeros(1, 1, 512)
-        return True
+            import torch
+            return (torch.zeros(1, 1, 512), torch.zeros(1, 1, 512))
+        elif self.method == 'word2vec_notarget_rnn' or self.method == 'word2vec_notarget_gru':
+            import torch
+            return torch.zeros(1, 1, 512)
+        # Feedforward methods have no hidden state
+        return None
+
+    def valid_actions(self):
+        """Mask [action_size] of the actions which do not collide (1 valid, 0 collision)"""
+        return ((self.action_mask[self.current_state_id] & self._action_bits) != 0).astype(np.uint8)
+
+    def get_state_id(self, pose):
+        """State id of a pose, None if the pose is not in the scene
+
+        Arguments:
+            pose {dict} -- {'position': {'x', 'y', 'z'}, 'rotation': {'x', 'y', 'z'}},
+                           without rotation the first state at this position is returned
+        """
+        return self.pose_index.get_state_id(pose['position'], pose.get('rotation'))
+
+    def snapshot(self):
+        """Capture the state of the current episode
+
+        Returns:
+            EpisodeSnapshot -- State to give to restore()
+        """
+        return EpisodeSnapshot(self.current_state_id, self.start_state_id,
+                               self.history.snapshot(), self.time,
+                               self.bbox_area, self.max_bbox_area, self.terminal,
+                               self.success, self.collided, self.last_action,
+                               getattr(self, 'hidden_state', None))
+
+    def restore(self, snapshot):
+        """Continue an episode from a snapshot, replaces reset() and replaying actions
+
+        Arguments:
+            snapshot {EpisodeSnapshot} -- State returned by snapshot()
+        """
+        self.current_state_id = snapshot.current_state_id
+        self.start_state_id = snapshot.start_state_id
+        self.history.restore(snapshot.history)
+        self.time = snapshot.time
+        self.bbox_area = snapshot.bbox_area
+        self.max_bbox_area = snapshot.max_bbox_area
+        self.terminal = snapshot.terminal
+        self.success = snapshot.success
+        self.collided = snapshot.collided
+        self.last_action = snapshot.last_action
+        self.hidden_state = snapshot.hidden_state
+        self._prefetch()
 
     def step(self, action):
         assert not self.terminal, 'step() called in terminal state'
@@ -204,11 +566,9 @@ class THORDiscreteEnvironment(Environment):
         if self.transition_graph[k][action] != -1:
             self.current_state_id = self.transition_graph[k][action]
             if self.reward_fun == 'env_goal':
-                for objectId in self.object_visibility[self.current_state_id]:
-                    obj = objectId.split('|')
-                    if obj[0] == self.terminal_state['object']:
-                        self.terminal = True
-                        self.success = True
+                if self._target_visible(self.current_state_id):
+                    self.terminal = True
+                    self.success = True
             elif self.reward_fun != "soft_goal":
                 agent_pos = self.locations[self.current_state_id]  # NDARRAY
                 # Check only y value
@@ -232,35 +592,50 @@ class THORDiscreteEnvironment(Environment):
             self.collided = True
 
         if self.method != "random":
-            self.s_t = np.append(self.s_t[:, 1:], self._get_state(
-                self.current_state_id), axis=1)
+            self.history.push(*self._get_frame(self.current_state_id))
 
         # Retrieve bounding box area of target object class
-        self.bbox_area = self._get_max_bbox_area(
-            self.boudingbox, self.terminal_state['object'])
+        self.bbox_area = self.target_bbox_area[self.current_state_id]
 
         self.time = self.time + 1
         self.last_action = action
+        self._prefetch()
 
-    def _get_state(self, state_id):
-        # read from hdf5 cache
+    def _prefetch(self):
+        # Read the neighborhood of the new state in the background
+        if self.prefetcher is not None:
+            self.prefetcher.request(self.current_state_id)
+
+    def _get_row(self, name, state_id):
+        if self.prefetcher is not None:
+            return self.prefetcher.get(name, state_id)
+        return self.h5_file[name][state_id]
+
+    def _get_frame(self, state_id):
+        # Random feature of the state and its key (state_id, feature index)
         k = random.randrange(self.n_feat_per_location)
-        return self.h5_file['resnet_feature'][state_id][k][:, np.newaxis]
+        return self._get_state(state_id, k), state_id * self.n_feat_per_location + k
+
+    def _get_state(self, state_id, k=None):
+        # read from hdf5 cache
+        if k is None:
+            k = random.randrange(self.n_feat_per_location)
+        if self.prefetcher is not None:
+            return self.prefetcher.get('resnet_feature', state_id)[k][:, np.newaxis]
+        if self.resnet_feature.dtype != self.history.frames.dtype:
+            return dequantize_features(self.resnet_feature[state_id][k], self.feature_scale,
+                                       self.feature_offset)[:, np.newaxis]
+        return self.resnet_feature[state_id][k][:, np.newaxis]
+
+    def _target_visible(self, state_id):
+        if self.target_object_id is None:
+            return False
+        return self.object_visibility[state_id, self.target_object_id]
 
     def _tiled_state(self, state_id):
         f = self._get_state(state_id)
         return np.tile(f, (1, self.history_length))
 
-    def _get_max_bbox_area(self, bboxs, obj_class):
-        area = 0
-        for key, value in bboxs.items():
-            keys = key.split('|')
-            if keys[0] == obj_class:
-                w = abs(value[0] - value[2])
-                h = abs(value[1] + value[3])
-                area = max(area, w * h)
-        return area
-
     def _calculate_bbox_reward(self):
         if self.bbox_area > self.max_bbox_area:
             self.max_bbox_area = self.bbox_area
@@ -268,26 +643,6 @@ class THORDiscreteEnvironment(Environment):
         else:
             return 0
 
-    def _downsample_bbox(self, input_shape, output_shape, input_bbox):
-        h, w = input_shape
-        out_h, out_w = output_shape
-        # Between 0 and output_shape
-        out_h = out_h - 1
-        out_w = out_w - 1
-
-        ratio_h = out_h / h
-        ratio_w = out_w / w
-
-        output = np.zeros(output_shape, dtype=np.float32)
-
-        for i_bbox in input_bbox:
-            bbox_xy, similarity = i_bbox
-            x, y = bbox_xy
-            out_x = int(x * ratio_w)
-            out_y = int(y * ratio_h)
-            output[out_x, out_y] = max(output[out_x, out_y], similarity)
-        return output
-
     @property
     def reward(self):
         if self.reward_fun == 'bbox':
@@ -307,18 +662,39 @@ class THORDiscreteEnvironment(Environment):
 
     @property
     def observation(self):
-        return self.h5_file['observation'][self.current_state_id]
+        return self._get_row('observation', self.current_state_id)
 
     @property
     def boudingbox(self):
         if self.bbox_method is None:
-            return json.loads(self.h5_file['bbox'][self.current_state_id])
+            return json.loads(self._get_row('bbox', self.current_state_id))
         elif self.bbox_method == 'yolo':
-            return json.loads(self.h5_file['yolo_bbox'][self.current_state_id])
+            return json.loads(self._get_row('yolo_bbox', self.current_state_id))
+
+    @property
+    def s_t(self):
+        return self.history.stacked()
 
     def render(self, mode):
         assert mode == 'resnet_features'
-        return self.s_t
+        return self.history.stacked()
+
+    def render_tensor(self, mode, device):
+        """Stacked frames as a tensor on device, without copy when possible"""
+        assert mode == 'resnet_features'
+        return self.history.stacked_tensor(device)
+
+    def render_last_frame(self, device):
+        """Latest frame as a tensor on device (used by recurrent networks)"""
+        return self.history.last_tensor(device)
+
+    def render_resnet_score_tensor(self, device):
+        """[1, 1000] resnet50 scores of the current state on device, None if not precomputed"""
+        if self.resnet_score is None:
+            return None
+        import torch
+        return torch.from_numpy(
+            self.resnet_score[self.current_state_id][np.newaxis]).to(device)
 
     def render_target(self, mode):
         if self.method == 'aop' or self.method == 'aop_we' or self.method == 'word2vec' or self.method == 'word2vec_nosimi' or self.method == 'word2vec_noconv' or self.method == "gcn":
@@ -328,113 +704,59 @@ class THORDiscreteEnvironment(Environment):
             assert mode == 'resnet_features'
             return self.s_target
 
-    def render_mask_similarity(self):
-        # Get shape of observation to downsample bbox location
-        h, w, _ = np.shape(self.h5_file['observation'][0])
-
-        bbox_location = []
-        for key, value in self.boudingbox.items():
-            keys = key.split('|')
+    def render_target_tensor(self, mode, device):
+        """Target as a tensor on device, created once per device"""
+        import torch
+        device = torch.device(device)
+        if device not in self._target_tensors:
+            self._target_tensors[device] = torch.from_numpy(
+                np.asarray(self.render_target(mode))).to(device)
+        return self._target_tensors[device]
+
+    def similarity_grid_table(self):
+        """[n_locations, 1, 1, mask_size, mask_size] similarity grid of every state"""
+        if self._similarity_grid is None:
+            # Similarity of the target with every object, ignore unknown ObjectId
+            similarity = cosine_similarity(self.object_vector, self.s_target)
+            known = self.bbox_object != -1
+            grid = bbox_grid(self.n_locations, self.frame_shape,
+                             (self.mask_size, self.mask_size),
+                             self.bbox_state[known], self.bbox_coord[known],
+                             similarity[self.bbox_object[known]])
+            self._similarity_grid = grid[:, np.newaxis, np.newaxis, ...]
+        return self._similarity_grid
+
+    def target_grid_table(self):
+        """[n_locations, mask_size, mask_size] bounding boxes of the target in every state"""
+        if self._target_grid is None:
             # Add bounding box if its the target object
-            # if keys[0] == self.terminal_state['object']:
-            # value[0] = start_x
-            # value[2] = end_x
-            x = value[0] + value[2]
-            x = x/2
-
-            # value[1] = start_y
-            # value[3] = end_y
-            y = value[1] + value[3]
-            y = y/2
-
-            # Ignore unknown ObjectId
-            if keys[0] not in self.object_ids:
-                continue
-
-            curr_obj_id = self.object_ids[keys[0]]
-            similarity = 1 - spatial.distance.cosine(
-                self.s_target, self.object_vector[curr_obj_id])
-            # for x in range(value[0], value[2], 1):
-            #     for y in range(value[1], value[3], 1):
-            bbox_location.append(((x, y), similarity))
-        try:
-            output = self._downsample_bbox(
-                (h, w), (self.mask_size, self.mask_size), bbox_location)
-        except IndexError as e:
-            print((h, w), bbox_location)
-            raise e
-        return output[np.newaxis, np.newaxis, ...]
+            target = self.bbox_object == self.target_object_id
+            self._target_grid = bbox_grid(self.n_locations, self.frame_shape,
+                                          (self.mask_size, self.mask_size),
+                                          self.bbox_state[target], self.bbox_coord[target],
+                                          np.ones(np.count_nonzero(target)))
+        return self._target_grid
+
+    def render_mask_similarity(self):
+        return self.similarity_grid_table()[self.current_state_id]
 
     def render_mask(self):
-        # Get shape of observation to downsample bbox location
-        h, w, _ = np.shape(self.h5_file['observation'][0])
-
-        bbox_location = []
-        for key, value in self.boudingbox.items():
-            keys = key.split('|')
-            if keys[0] == self.terminal_state['object']:
-                # Add bounding box if its the target object
-                # if keys[0] == self.terminal_state['object']:
-                # value[0] = start_x
-                # value[2] = end_x
-                x = value[0] + value[2]
-                x = x/2
-
-                # value[1] = start_y
-                # value[3] = end_y
-                y = value[1] + value[3]
-                y = y/2
-                bbox_location.append(((x, y), 1))
-        try:
-            output = self._downsample_bbox(
-                (h, w), (self.mask_size, self.mask_size), bbox_location)
-        except IndexError as e:
-            print((h, w), bbox_location)
-            raise e
-        return output
+        return self.target_grid_table()[self.current_state_id]
 
     def accessible_terminal(self, state):
-
-        if self.reward_fun == 'soft_goal' or self.reward_fun == 'env_goal':
-            lengths = []
-            for i, object_visibility in enumerate(self.object_visibility):
-                for objectId in object_visibility:
-                    obj = objectId.split('|')
-                    if obj[0] == self.terminal_state['object']:
-                        if self.shortest_path_distance[state][i] != -1:
-                            return True
-            return False
-        else:
-            return self.shortest_path_distance[state][self.terminal_id] != -1
+        return self.goal_distance[state] != -1
 
     def shortest_path_terminal(self, state):
-
-        if self.reward_fun == 'soft_goal' or self.reward_fun == 'env_goal':
-            lengths = []
-            for i, object_visibility in enumerate(self.object_visibility):
-                for objectId in object_visibility:
-                    obj = objectId.split('|')
-                    if obj[0] == self.terminal_state['object']:
-                        if self.shortest_path_distance[state][i] != -1:
-                            lengths.append(
-                                self.shortest_path_distance[state][i])
-                            break
-            try:
-                min_len = np.min(lengths)
-            except Exception as e:
-                print(self.scene, self.terminal_state)
-                print(e)
-                raise e
-            return min_len
-        else:
-            return self.shortest_path_distance[state][self.terminal_id]
+        return self.goal_distance[state]
 
     @property
     def actions(self):
         return self.acts[: self.action_size]
 
     def stop(self):
-        pass
+        # A shared scene is closed by its owner
+        if self.owns_scene:
+            self.thor_scene.close()
 
     def reward_soft_goal(self):
         GOAL_SUCCESS_REWARD = 5
@@ -442,10 +764,8 @@ class THORDiscreteEnvironment(Environment):
         # BBOX area
         reward_ = self._calculate_bbox_reward()
 
-        h, w, _ = np.shape(self.h5_file['observation'][0])
-
         # Normalize
-        reward_ = reward_ / (h*w)
+        reward_ = reward_ / self.frame_area
 
         # Use strict done
         # Emitted Done signal will trigger end of episode
@@ -454,12 +774,9 @@ class THORDiscreteEnvironment(Environment):
             self.success = False
             self.terminal = True
             # Check if object is visible
-            for objectId in self.object_visibility[self.current_state_id]:
-                obj = objectId.split('|')
-                if obj[0] == self.terminal_state['object']:
-                    reward_ = reward_ + GOAL_SUCCESS_REWARD
-                    self.success = True
-                    break
+            if self._target_visible(self.current_state_id):
+                reward_ = reward_ + GOAL_SUCCESS_REWARD
+                self.success = True
         else:
             reward_ = reward_ + STEP_PENALTY
 
@@ -471,21 +788,16 @@ class THORDiscreteEnvironment(Environment):
         # BBOX area
         reward_ = self._calculate_bbox_reward()
 
-        h, w, _ = np.shape(self.h5_file['observation'][0])
-
         # Normalize
-        reward_ = reward_ / (h*w)
+        reward_ = reward_ / self.frame_area
 
         # Use strict done
         # Emitted Done signal will trigger end of episode
         # Giving big reward only if object is visible
         # Check if object is visible
-        for objectId in self.object_visibility[self.current_state_id]:
-            obj = objectId.split('|')
-            if obj[0] == self.terminal_state['object']:
-                reward_ = reward_ + GOAL_SUCCESS_REWARD
-                self.success = True
-                break
+        if self._target_visible(self.current_state_id):
+            reward_ = reward_ + GOAL_SUCCESS_REWARD
+            self.success = True
         else:
             reward_ = reward_ + STEP_PENALTY
 
@@ -495,4 +807,11 @@ class THORDiscreteEnvironment(Environment):
         self.hidden_state = hidden
 
     def render_hidden_state(self):
+        import torch
+        # A hidden state set in inference mode can not be saved for backward,
+        # a copy is returned when autograd is enabled
+        if torch.is_grad_enabled():
+            if isinstance(self.hidden_state, tuple):
+                return tuple(h.clone() for h in self.hidden_state)
+            return self.hidden_state.clone()
         return self.hidden_state
\ No newline at end of file
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class FrameHistory:
+    """Ring buffer of the last observation features of an environment
+
+    Frames are written in place, one row per frame. The network expects the
+    stacked history as a [feature_size, history_length] matrix with the oldest
+    frame first, this layout is only built when it is requested and is kept in
+    a preallocated array. torch is only imported by the *_tensor methods so
+    that numpy-only processes (see agent/numpy_policy.py) do not load it.
+    """
+
+    def __init__(self, feature_size=2048, history_length=4, dtype=np.float32):
+        self.history_length = history_length
+
+        # Ring buffer, self.head is the slot of the oldest frame
+        self.frames = np.zeros((history_length, feature_size), dtype=dtype)
+        self.head = 0
+
+        # Identifier of the frame of each slot given by the caller, -1 if unknown
+        self.keys = np.full(history_length, -1, dtype=np.int64)
+        self._orders = [(np.arange(history_length) + head) % history_length
+                        for head in range(history_length)]
+
+        # Chronological stack, the tensor sharing its memory is created on first use
+        self._stacked = np.zeros((feature_size, history_length), dtype=dtype)
+        self._stacked_tensor = None
+        self._dirty = True
+
+    def fill(self, frame, key=-1):
+        """Set every frame of the history to frame (start of an episode)"""
+        self.frames[...] = frame.reshape(1, -1)
+        self.keys[...] = key
+        self.head = 0
+        self._dirty = True
+
+    def push(self, frame, key=-1):
+        """Replace the oldest frame with frame"""
+        self.frames[self.head] = frame.reshape(-1)
+        self.keys[self.head] = key
+        self.head = (self.head + 1) % self.history_length
+        self._dirty = True
+
+    def last(self):
+        """Latest frame, view of the ring buffer"""
+        return self.frames[self.head - 1]
+
+    def chronological(self):
+        """[history_length, feature_size] frames and their keys, oldest frame first"""
+        order = self._orders[self.head]
+        return self.frames[order], self.keys[order]
+
+    def snapshot(self):
+        """Copy of the ring buffer, its keys and its head"""
+        return self.frames.copy(), self.keys.copy(), self.head
+
+    def restore(self, snapshot):
+        """Set the history back to a snapshot"""
+        frames, keys, self.head = snapshot
+        np.copyto(self.frames, frames)
+        np.copyto(self.keys, keys)
+        self._dirty = True
+
+    def stacked(self):
+        """[feature_size, history_length] history, oldest frame first"""
+        if self._dirty:
+            np.copyto(self._stacked, self.frames[self._orders[self.head]].T)
+            self._dirty = False
+        return self._stacked
+
+    def stacked_tensor(self, device):
+        """Stacked history as a tensor on device
+
+        On CPU without autograd the preallocated tensor is returned without
+        copy. When autograd is enabled the network keeps its input for the
+        backward pass while the buffer is overwritten by the next step, a copy
+        is returned instead.
+        """
+        import torch
+        device = torch.device(device)
+        if self._stacked_tensor is None:
+            self._stacked_tensor = torch.from_numpy(self._stacked)
+        self._pin_memory(device)
+        self.stacked()
+        return self._to_device(self._stacked_tensor, device)
+
+    def last_tensor(self, device):
+        """Latest frame as a tensor on device, see stacked_tensor"""
+        import torch
+        device = torch.device(device)
+        self._pin_memory(device)
+        return self._to_device(torch.from_numpy(self.last()), device)
+
+    def _to_device(self, tensor, device):
+        import torch
+        if device.type != 'cpu':
+            return tensor.to(device)
+        if torch.is_grad_enabled():
+            return tensor.clone()
+        return tensor
+
+    def _pin_memory(self, device):
+        # Page-locked buffers speed up host to GPU copies, allocated on first use
+        # so that processes which never use the GPU do not initialize CUDA
+        import torch
+        if device.type != 'cuda' or self._stacked_tensor.is_pinned():
+            return
+        self.frames = torch.from_numpy(self.frames).pin_memory().numpy()
+        self._stacked_tensor = self._stacked_tensor.pin_memory()
+        self._stacked = self._stacked_tensor.numpy()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Positions are quantized to the centimeter and angles to the degree
+POSITION_SCALE = 100
+
+
+def pose_key(position, rotation):
+    """Integer (x, z, yaw, horizon) key of a pose
+
+    Arguments:
+        position {dict} -- Agent position {'x', 'y', 'z'}
+        rotation {dict} -- Agent rotation {'x', 'y', 'z'}, z is the camera horizon
+
+    Returns:
+        tuple -- Quantized pose
+    """
+    return (int(round(position['x'] * POSITION_SCALE)),
+            int(round(position['z'] * POSITION_SCALE)),
+            int(round(rotation['y'])) % 360,
+            int(round(rotation['z'])) % 360)
+
+
+def pose_keys(locations, rotations):
+    """Vectorized pose_key over the location and rotation datasets of a scene
+
+    Arguments:
+        locations {np.ndarray} -- [n, 3] (x, y, z) of every state
+        rotations {np.ndarray} -- [n, 3] (x, yaw, horizon) of every state
+
+    Returns:
+        np.ndarray -- [n, 4] int64 keys
+    """
+    keys = np.empty((len(locations), 4), dtype=np.int64)
+    keys[:, 0] = np.rint(locations[:, 0] * POSITION_SCALE)
+    keys[:, 1] = np.rint(locations[:, 2] * POSITION_SCALE)
+    keys[:, 2] = np.rint(rotations[:, 1]) % 360
+    keys[:, 3] = np.rint(rotations[:, 2]) % 360
+    return keys
+
+
+class PoseIndex:
+    """Hash index from a pose to its state id
+
+    When several states share a key the first one is kept, the same state a
+    linear scan over the states would find.
+    """
+
+    def __init__(self, keys=None):
+        self.poses = dict()
+        self.positions = dict()
+        if keys is not None:
+            for state_id, key in enumerate(np.asarray(keys).tolist()):
+                self.add(tuple(key), state_id)
+
+    def add(self, key, state_id):
+        self.poses.setdefault(key, state_id)
+        self.positions.setdefault(key[:2], state_id)
+
+    def get_state_id(self, position, rotation=None):
+        """State id of a pose, None if the pose is not in the scene
+
+        Arguments:
+            position {dict} -- Agent position {'x', 'y', 'z'}
+
+        Keyword Arguments:
+            rotation {dict} -- Agent rotation {'x', 'y', 'z'}, any rotation if None (default: {None})
+        """
+        if rotation is None:
+            return self.positions.get(pose_key(position, {'y': 0, 'z': 0})[:2])
+        return self.poses.get(pose_key(position, rotation))
+
+    def __contains__(self, key):
+        return key in self.poses
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class StatePrefetcher:
+    """Bounded cache of h5 rows filled by a background thread
+
+    Used when a scene does not fit in memory. Each time the agent moves,
+    request() queues the states reachable within depth actions of the new
+    state (following the transition graph) and a background thread reads
+    their rows from the h5 file. get() only reads from the cache, a row which
+    is not there yet is read synchronously and counted as a miss.
+
+    A dataset is prefetched once it has been read at least once with get(),
+    so that rows never used by the caller (e.g. observations during training)
+    are not read from disk.
+    """
+
+    def __init__(self, h5_file, transition_graph, depth=2, capacity=2048):
+        """StatePrefetcher constructor
+
+        Arguments:
+            h5_file {h5py.File} -- Opened scene dataset
+            transition_graph {np.ndarray} -- [n_states, n_actions] destination state id, -1 for collision
+
+        Keyword Arguments:
+            depth {int} -- Number of action to look ahead (default: {2})
+            capacity {int} -- Maximum number of state kept in cache (default: {2048})
+        """
+        self.h5_file = h5_file
+        self.transition_graph = transition_graph
+        self.depth = depth
+        self.capacity = capacity
+
+        self.datasets = []
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def neighbors(self, state_id):
+        """States reachable within depth actions, closest first"""
+        states = [state_id]
+        seen = {state_id}
+        frontier = np.array([state_id])
+        for _ in range(self.depth):
+            frontier = np.unique(self.transition_graph[frontier])
+            frontier = np.array([s for s in frontier.tolist()
+                                 if s != -1 and s not in seen], dtype=np.int64)
+            seen.update(frontier.tolist())
+            states.extend(frontier.tolist())
+        return states
+
+    def request(self, state_id):
+        """Prefetch the neighborhood of state_id in the background"""
+        with self.lock:
+            missing = [s for s in self.neighbors(state_id)
+                       if not all(name in self.cache.get(s, ()) for name in self.datasets)]
+        if missing and self.datasets:
+            self.queue.put(missing)
+
+    def get(self, name, state_id):
+        """Row state_id of dataset name"""
+        with self.lock:
+            rows = self.cache.get(state_id)
+            if rows is not None and name in rows:
+                self.cache.move_to_end(state_id)
+                self.hits += 1
+                return rows[name]
+            self.misses += 1
+            if name not in self.datasets:
+                self.datasets.append(name)
+        row = self.h5_file[name][state_id]
+        self._insert(name, [state_id], [row])
+        return row
+
+    def stats(self):
+        """Number of hit, miss and hit rate of get()"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _insert(self, name, state_ids, rows):
+        with self.lock:
+            for state_id, row in zip(state_ids, rows):
+                self.cache.setdefault(state_id, dict())[name] = row
+                self.cache.move_to_end(state_id)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def _run(self):
+        while True:
+            states = self.queue.get()
+            # Only the latest request matters if the agent moved in between
+            while states is not None and not self.queue.empty():
+                states = self.queue.get()
+            if states is None:
+                return
+            for name in list(self.datasets):
+                with self.lock:
+                    # h5py fancy indexing needs increasing indices
+                    missing = sorted(s for s in states
+                                     if name not in self.cache.get(s, ()))
+                if missing:
+                    self._insert(name, missing, self.h5_file[name][missing])
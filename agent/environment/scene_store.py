@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import json
+
+import h5py
+import numpy as np
+
+from agent.environment.pose_index import pose_keys
+
+
+def parse_bbox(dataset, object_ids):
+    """Flatten the json bounding boxes of every state
+
+    Arguments:
+        dataset {h5py.Dataset} -- bbox or yolo_bbox dataset, one json dict per state
+        object_ids {dict} -- object name to object id
+
+    Returns:
+        tuple -- state id, object id (-1 for unknown object) and [x1, y1, x2, y2] of every box
+    """
+    states, objects, coords = [], [], []
+    for state_id, j in enumerate(dataset):
+        for key, value in json.loads(j).items():
+            keys = key.split('|')
+            states.append(state_id)
+            objects.append(object_ids.get(keys[0], -1))
+            coords.append(value)
+    return (np.array(states, dtype=np.int64),
+            np.array(objects, dtype=np.int64),
+            np.array(coords, dtype=np.float64).reshape(-1, 4))
+
+
+def max_bbox_area(n_states, n_objects, bbox_state, bbox_object, bbox_coord):
+    """Area of the largest bounding box of every object class in every state
+
+    Arguments:
+        n_states {int} -- Number of state in the scene
+        n_objects {int} -- Number of object class
+        bbox_state {np.ndarray} -- [n_bbox] state id of each box
+        bbox_object {np.ndarray} -- [n_bbox] object id of each box (-1 for unknown object)
+        bbox_coord {np.ndarray} -- [n_bbox, 4] (x1, y1, x2, y2) of each box
+
+    Returns:
+        np.ndarray -- [n_states, n_objects] max area, 0 if the object is not in the state
+    """
+    known = bbox_object != -1
+    coord = bbox_coord[known]
+    w = np.abs(coord[:, 0] - coord[:, 2])
+    # Same area as the original reward, keep it as is for comparable results
+    h = np.abs(coord[:, 1] + coord[:, 3])
+    area = np.zeros((n_states, n_objects), dtype=np.float64)
+    np.maximum.at(area, (bbox_state[known], bbox_object[known]), w * h)
+    return area
+
+
+def quantize_features(features, feature_dtype):
+    """Compress resnet features to reduce the memory used by a scene
+
+    float16 features are a plain cast. int8 features are quantized per channel
+    (last axis) between the min and max of the channel over the scene,
+    features are recovered with dequantize_features.
+
+    Arguments:
+        features {np.ndarray} -- [n_states, n_feat_per_location, 2048] float32 features
+        feature_dtype {str} -- float32, float16 or int8
+
+    Returns:
+        dict -- resnet_feature and for int8 resnet_feature_scale, resnet_feature_offset
+    """
+    if feature_dtype == 'float32':
+        return {'resnet_feature': features}
+    elif feature_dtype == 'float16':
+        return {'resnet_feature': features.astype(np.float16)}
+    elif feature_dtype == 'int8':
+        channels = features.reshape(-1, features.shape[-1])
+        low = channels.min(axis=0)
+        scale = (channels.max(axis=0) - low) / 255
+        scale[scale == 0] = 1
+        quantized = np.rint((features - low) / scale) - 128
+        return {'resnet_feature': quantized.astype(np.int8),
+                'resnet_feature_scale': scale.astype(np.float32),
+                'resnet_feature_offset': (low + 128 * scale).astype(np.float32)}
+    raise Exception(f'Unknown feature dtype {feature_dtype}')
+
+
+def dequantize_features(features, scale=None, offset=None):
+    """float32 features from the output of quantize_features"""
+    if scale is not None:
+        return features * scale + offset
+    return features.astype(np.float32)
+
+
+def load_scene_arrays(h5_file, resnet_feature=True, feature_dtype='float32'):
+    """Read the arrays of a scene needed by THORDiscreteEnvironment
+
+    Arguments:
+        h5_file {h5py.File} -- Opened scene dataset
+
+    Keyword Arguments:
+        resnet_feature {bool} -- Read the resnet features, False when they are streamed (default: {True})
+        feature_dtype {str} -- Type of the resnet features in memory, see quantize_features (default: {'float32'})
+
+    Returns:
+        dict -- numpy arrays (location, rotation, pose_key, graph, action_mask, resnet_feature,
+                resnet_score if available, object_visibility, flattened bounding boxes and
+                max bounding box area)
+    """
+    object_ids = json.loads(h5_file.attrs['object_ids'])
+    n_locations = h5_file['location'].shape[0]
+
+    # Object visibility is stored as json list of objectId ("ObjectName|x|y|z")
+    # Convert it once to a boolean matrix indexed by [state_id, object_id]
+    object_visibility = np.zeros(
+        (n_locations, max(object_ids.values()) + 1), dtype=bool)
+    for state_id, j in enumerate(h5_file['object_visibility']):
+        for objectId in json.loads(j):
+            obj = objectId.split('|')
+            if obj[0] in object_ids:
+                object_visibility[state_id, object_ids[obj[0]]] = True
+
+    arrays = {
+        'location': h5_file['location'][()],
+        'rotation': h5_file['rotation'][()],
+        'graph': h5_file['graph'][()],
+        'object_visibility': object_visibility,
+    }
+    if resnet_feature:
+        arrays.update(quantize_features(h5_file['resnet_feature'][()], feature_dtype))
+    # Scores of the frozen resnet50 used by gcn, small enough to stay in memory when streaming
+    if 'resnet_score' in h5_file:
+        arrays['resnet_score'] = h5_file['resnet_score'][()]
+    arrays['pose_key'] = pose_keys(arrays['location'], arrays['rotation'])
+
+    # Bit a is set if action a does not collide (graph value != -1)
+    arrays['action_mask'] = np.sum(
+        (arrays['graph'] != -1) << np.arange(arrays['graph'].shape[1]),
+        axis=1).astype(np.uint16)
+
+    # Groundtruth and yolo bounding boxes
+    for name in ['bbox', 'yolo_bbox']:
+        if name in h5_file:
+            (arrays[name + '_state'],
+             arrays[name + '_object'],
+             arrays[name + '_coord']) = parse_bbox(h5_file[name], object_ids)
+            arrays[name + '_area'] = max_bbox_area(
+                n_locations, object_visibility.shape[1], arrays[name + '_state'],
+                arrays[name + '_object'], arrays[name + '_coord'])
+    return arrays
+
+
+class SceneStore:
+    """Scene arrays loaded once and shared between processes
+
+    Arrays are kept as torch tensors so that share_memory() moves them to shared
+    memory. TrainingThread then receive them through torch.multiprocessing
+    without copy and environments attach to them as numpy views. Types torch
+    does not support (bool, uint16) are stored as a view of the same width and
+    viewed back by get().
+    """
+
+    def __init__(self, h5_file_path, resnet_feature=True, feature_dtype='float32'):
+        """SceneStore constructor
+
+        Arguments:
+            h5_file_path {str} -- Path to precomputed world, '{scene}' is replaced by the scene name
+
+        Keyword Arguments:
+            resnet_feature {bool} -- Load the resnet features, False when they are streamed (default: {True})
+            feature_dtype {str} -- Type of the resnet features in memory, see quantize_features (default: {'float32'})
+        """
+        self.h5_file_path = h5_file_path
+        self.resnet_feature = resnet_feature
+        self.feature_dtype = feature_dtype
+        self.dtypes = dict()
+        self.scenes = dict()
+        self.start_pools = dict()
+
+    def load(self, scene_name):
+        if scene_name not in self.scenes:
+            h5_file = h5py.File(
+                self.h5_file_path.replace('{scene}', scene_name), 'r')
+            arrays = load_scene_arrays(h5_file, self.resnet_feature, self.feature_dtype)
+            h5_file.close()
+            import torch
+            self.dtypes[scene_name] = {k: v.dtype for k, v in arrays.items()}
+            self.scenes[scene_name] = {k: torch.from_numpy(self._torch_view(v))
+                                       for k, v in arrays.items()}
+        return self.get(scene_name)
+
+    def share_memory(self):
+        for arrays in self.scenes.values():
+            for tensor in arrays.values():
+                tensor.share_memory_()
+        for tensor in self.start_pools.values():
+            tensor.share_memory_()
+
+    def get(self, scene_name):
+        dtypes = self.dtypes[scene_name]
+        return {k: v.numpy().view(dtypes[k]) for k, v in self.scenes[scene_name].items()}
+
+    @staticmethod
+    def _torch_view(array):
+        if array.dtype == bool:
+            return array.view(np.uint8)
+        if array.dtype == np.uint16:
+            return array.view(np.int16)
+        return array
+
+    def add_start_pool(self, key, pool):
+        import torch
+        self.start_pools[key] = torch.from_numpy(np.asarray(pool, dtype=np.int64))
+
+    def has_start_pool(self, key):
+        return key in self.start_pools
+
+    def get_start_pool(self, key):
+        return self.start_pools[key].numpy()
+
+    def save_start_pools(self, path):
+        np.savez(path, **{k: v.numpy() for k, v in self.start_pools.items()})
+
+    def check_start_pools(self, path):
+        """Raise if a start pool saved in path differs from the computed one of the same task"""
+        with np.load(path) as pools:
+            for key in pools.files:
+                if key in self.start_pools and not np.array_equal(pools[key], self.get_start_pool(key)):
+                    raise Exception(f'Start pool of {key} in {path} does not match the dataset, '
+                                    'the dataset changed since it was saved')
+
+    def __contains__(self, scene_name):
+        return scene_name in self.scenes
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from agent.environment.ai2thor_file import THORDiscreteEnvironment
+from agent.environment.environment import Environment
+from agent.environment.scene_store import dequantize_features
+
+
+class VecTHORDiscreteEnvironment(Environment):
+    """N concurrent episodes of THORDiscreteEnvironment stepped at once
+
+    Episodes can mix scenes and targets. The static tables of every episode
+    (transition graph, start pool, goal and bbox area of the target) are
+    concatenated in flat arrays and the state of the episodes (current state,
+    time, history, flags) is kept in arrays of size N, so a step is a few
+    fancy indexing operations instead of N python calls.
+
+    Finished episodes are reset automatically at the end of step(), every
+    per-episode state is reset, the hidden state of a recurrent network is
+    kept by the caller and must be reset for the episodes done. The
+    observation images are not loaded, gcn is not supported.
+    """
+
+    acts = THORDiscreteEnvironment.acts
+
+    def __init__(self, episodes, seed=None, **kwargs):
+        """VecTHORDiscreteEnvironment constructor
+
+        Arguments:
+            episodes {list} -- One dict per episode (scene_name, terminal_state), overriding kwargs
+
+        Keyword Arguments:
+            seed {int} -- Seed of the random generator (start state and feature choice) (default: {None})
+            kwargs -- THORDiscreteEnvironment arguments common to every episode (method, reward, ...)
+        """
+        super(VecTHORDiscreteEnvironment, self).__init__()
+        self.rng = np.random.default_rng(seed)
+        self.n_envs = len(episodes)
+
+        envs = [THORDiscreteEnvironment(**{**kwargs, **episode})
+                for episode in episodes]
+        if envs[0].resnet_feature is None:
+            raise Exception('VecTHORDiscreteEnvironment needs the resnet features in memory, '
+                            'streaming is not supported')
+
+        self.method = envs[0].method
+        if self.method == 'gcn':
+            raise Exception('VecTHORDiscreteEnvironment can not render the inputs of gcn')
+        self.reward_fun = envs[0].reward_fun
+        self.action_size = envs[0].action_size
+        self.history_length = envs[0].history_length
+        self.n_feat_per_location = envs[0].n_feat_per_location
+        self.done_action = self.acts.index('Done')
+
+        # Scene arrays, shared by episodes in the same scene
+        self.scenes = []
+        self.resnet_features = []
+        self.feature_scales = []
+        graphs = []
+        scene_index = []
+        for env in envs:
+            if env.scene not in self.scenes:
+                self.scenes.append(env.scene)
+                self.resnet_features.append(env.resnet_feature)
+                self.feature_scales.append((env.feature_scale, env.feature_offset))
+                graphs.append(env.transition_graph)
+            scene_index.append(self.scenes.index(env.scene))
+        self.scene_index = np.array(scene_index, dtype=np.int64)
+        self.graph = np.concatenate(graphs).astype(np.int64)
+        self.graph_offset = np.cumsum([0] + [len(g) for g in graphs[:-1]])[self.scene_index]
+
+        # Target tables of every episode
+        self.table_offset = np.cumsum([0] + [env.n_locations for env in envs[:-1]])
+        self.visible = np.concatenate([
+            env.object_visibility[:, env.target_object_id]
+            if env.target_object_id is not None else np.zeros(env.n_locations, dtype=bool)
+            for env in envs])
+        self.reached = np.concatenate([self._reached(env) for env in envs])
+        self.bbox_area_table = np.concatenate([env.target_bbox_area for env in envs])
+        self.frame_area = np.array([env.frame_area for env in envs], dtype=np.float64)
+
+        for env in envs:
+            if len(env.start_pool) == 0:
+                raise Exception(f"No accessible start state in {env.scene} "
+                                f"for {env.terminal_state['object']}")
+        self.pool = np.concatenate([env.start_pool for env in envs]).astype(np.int64)
+        self.pool_offset = np.cumsum([0] + [len(env.start_pool) for env in envs[:-1]])
+        self.pool_length = np.array([len(env.start_pool) for env in envs])
+
+        # Target given as input to the network
+        if self.method == 'random':
+            self.s_target = None
+        else:
+            self.s_target = np.stack([np.asarray(env.s_target) for env in envs])
+
+        # Grids of every state given as input to the network
+        self.similarity_grid = None
+        self.target_grid = None
+        if self.method.startswith('word2vec') and self.method != 'word2vec_nosimi':
+            self.similarity_grid = np.concatenate([env.similarity_grid_table() for env in envs])
+        elif self.method == 'aop' or self.method == 'aop_we':
+            self.target_grid = np.concatenate([env.target_grid_table() for env in envs])
+
+        for env in envs:
+            env.stop()
+
+        # Episodes state
+        feature_size = self.resnet_features[0].shape[-1]
+        self.frames = np.zeros((self.n_envs, self.history_length, feature_size),
+                               dtype=np.result_type(self.resnet_features[0].dtype, np.float32))
+        self.head = np.zeros(self.n_envs, dtype=np.int64)
+        self.current_state_id = np.zeros(self.n_envs, dtype=np.int64)
+        self.start_state_id = np.zeros(self.n_envs, dtype=np.int64)
+        self.time = np.zeros(self.n_envs, dtype=np.int64)
+        self.last_action = np.full(self.n_envs, -1, dtype=np.int64)
+        self.terminal = np.zeros(self.n_envs, dtype=bool)
+        self.success = np.zeros(self.n_envs, dtype=bool)
+        self.collided = np.zeros(self.n_envs, dtype=bool)
+        self.bbox_area = np.zeros(self.n_envs)
+        self.max_bbox_area = np.zeros(self.n_envs)
+
+    def _reached(self, env):
+        # Same terminal condition as THORDiscreteEnvironment.step (location and y rotation)
+        reached = np.zeros(env.n_locations, dtype=bool)
+        if self.reward_fun != 'soft_goal' and self.reward_fun != 'env_goal':
+            terminal_pos = list(env.terminal_state['position'].values())
+            reached = np.all(env.locations == terminal_pos, axis=1) & \
+                (env.rotations[:, 1] == env.terminal_state['rotation']['y'])
+        return reached
+
+    def _get_frames(self, idx):
+        # One random feature per location for every episode in idx, gathered by scene
+        states = self.current_state_id[idx]
+        frames = np.empty((len(idx), self.frames.shape[-1]), dtype=self.frames.dtype)
+        k = self.rng.integers(self.n_feat_per_location, size=len(idx))
+        for s, resnet_feature in enumerate(self.resnet_features):
+            in_scene = self.scene_index[idx] == s
+            frames[in_scene] = dequantize_features(
+                resnet_feature[states[in_scene], k[in_scene]], *self.feature_scales[s])
+        return frames
+
+    def reset(self, idx=None):
+        """Start a new episode from a random start state
+
+        Keyword Arguments:
+            idx {np.ndarray} -- Episodes to reset, every episode if None (default: {None})
+        """
+        if idx is None:
+            idx = np.arange(self.n_envs)
+        idx = np.asarray(idx, dtype=np.int64)
+        choice = (self.rng.random(len(idx)) * self.pool_length[idx]).astype(np.int64)
+        self.current_state_id[idx] = self.pool[self.pool_offset[idx] + choice]
+        self.start_state_id[idx] = self.current_state_id[idx]
+
+        self.frames[idx] = self._get_frames(idx)[:, np.newaxis, :]
+        self.head[idx] = 0
+        self.collided[idx] = False
+        self.terminal[idx] = False
+        self.bbox_area[idx] = 0
+        self.max_bbox_area[idx] = 0
+        self.time[idx] = 0
+        self.success[idx] = False
+        self.last_action[idx] = -1
+
+    def step(self, actions):
+        """Apply one action in every episode
+
+        Arguments:
+            actions {np.ndarray} -- [N] action of every episode
+
+        Returns:
+            tuple -- rewards, done and success of the step, finished episodes are then reset
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        move = np.flatnonzero(actions != self.done_action)
+        done_action = actions == self.done_action
+
+        # Move, -1 in the graph is a collision
+        k = self.current_state_id[move]
+        next_state = self.graph[self.graph_offset[move] + k, actions[move]]
+        valid = next_state != -1
+        self.current_state_id[move[valid]] = next_state[valid]
+        self.terminal[move[~valid]] = False
+        self.collided[move[~valid]] = True
+
+        moved = move[valid]
+        table = self.table_offset[moved] + self.current_state_id[moved]
+        if self.reward_fun == 'env_goal':
+            reached = self.visible[table]
+            self.terminal[moved[reached]] = True
+            self.success[moved[reached]] = True
+        elif self.reward_fun != 'soft_goal':
+            reached = self.reached[table]
+            self.terminal[moved] = reached
+            self.success[moved[reached]] = True
+            self.collided[moved] = False
+
+        # Push the new frame in the history
+        self.frames[move, self.head[move]] = self._get_frames(move)
+        self.head[move] = (self.head[move] + 1) % self.history_length
+
+        # Bounding box area of the target object class
+        self.bbox_area[move] = self.bbox_area_table[
+            self.table_offset[move] + self.current_state_id[move]]
+        self.time[move] += 1
+        self.last_action[:] = actions
+
+        rewards = self._reward(done_action)
+        dones = self.terminal | (self.time >= 200)
+        success = self.success.copy()
+        if np.any(dones):
+            self.reset(np.flatnonzero(dones))
+        return rewards, dones, success
+
+    def _reward(self, done_action):
+        # Bbox reward, the area is only rewarded when it is bigger than before
+        bbox_reward = np.where(self.bbox_area > self.max_bbox_area, self.bbox_area, 0)
+        self.max_bbox_area = np.maximum(self.max_bbox_area, self.bbox_area)
+
+        if self.reward_fun == 'bbox':
+            return bbox_reward
+        elif self.reward_fun == 'step':
+            return np.where(self.terminal, 10.0, -0.01)
+
+        visible = self.visible[self.table_offset + self.current_state_id]
+        reward = bbox_reward / self.frame_area
+        if self.reward_fun == 'soft_goal':
+            # Emitted Done signal will trigger end of episode
+            self.terminal[done_action] = True
+            self.success[done_action] = visible[done_action]
+            return reward + np.where(done_action, np.where(visible, 5, 0), -0.01)
+        elif self.reward_fun == 'env_goal':
+            self.success[visible] = True
+            return reward + np.where(visible, 5, -0.01)
+
+    def render(self, mode='resnet_features'):
+        """[N, feature_size, history_length] stacked history, oldest frame first"""
+        assert mode == 'resnet_features'
+        order = (self.head[:, np.newaxis] + np.arange(self.history_length)) % self.history_length
+        return self.frames[np.arange(self.n_envs)[:, np.newaxis], order].transpose(0, 2, 1)
+
+    def render_target(self, mode='word_features'):
+        return self.s_target
+
+    def render_mask_similarity(self):
+        """[N, 1, 1, mask_size, mask_size] similarity grid of the current states"""
+        assert self.similarity_grid is not None, self.method + ' has no similarity grid'
+        return self.similarity_grid[self.table_offset + self.current_state_id]
+
+    def render_mask(self):
+        """[N, mask_size, mask_size] bounding boxes of the target in the current states"""
+        assert self.target_grid is not None, self.method + ' has no bounding box grid'
+        return self.target_grid[self.table_offset + self.current_state_id]
+
+    @property
+    def is_terminal(self):
+        return self.terminal | (self.time >= 200)
+
+    @property
+    def actions(self):
+        return self.acts[: self.action_size]
+
+    def stop(self):
+        pass
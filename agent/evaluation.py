@@ -5,6 +5,7 @@ import imp
 import os
 import random
 import sys
+import time
 from itertools import groupby
 import json 
 import cv2
@@ -24,9 +25,10 @@ from agent.method.aop import AOP
 from agent.method.gcn import GCN
 from agent.method.similarity_grid import SimilarityGrid
 from agent.method.target_driven import TargetDriven
-from agent.network import SceneSpecificNetwork, SharedNetwork
+from agent.network import (SceneSpecificNetwork, SharedNetwork, create_scene_network,
+                           quantize_network, select_scene)
 from agent.training import TrainingSaver
-from agent.utils import find_restore_points, get_first_free_gpu
+from agent.utils import find_restore_points, get_first_free_gpu, inference_mode
 from torchvision import transforms
 
 #See https://stackoverflow.com/a/42721412
@@ -230,19 +232,27 @@ class Logger(object):
         self.log.close()
 
 class Evaluation:
-    def __init__(self, config):
+    def __init__(self, config, head_scenes=None):
         self.config = config
         self.method = config['method']
-        gpu_id = get_first_free_gpu(2000)
-        if gpu_id is None:
-            print("You need at least 2Go of GPU RAM")
-            exit()
-        self.device = torch.device("cuda:" + str(gpu_id))
+        # Int8 dynamic quantization of the linear layers, CPU only
+        self.quantize = config.get('quantize', False)
+        if self.quantize:
+            self.device = torch.device("cpu")
+        else:
+            gpu_id = get_first_free_gpu(2000)
+            if gpu_id is None:
+                print("You need at least 2Go of GPU RAM")
+                exit()
+            self.device = torch.device("cuda:" + str(gpu_id))
         if self.method != "random":
             self.shared_net = SharedNetwork(
-                self.config['method'], self.config.get('mask_size', 5)).to(self.device)
-            self.scene_net = SceneSpecificNetwork(
-                self.config['action_size']).to(self.device)
+                self.config['method'], self.config.get('mask_size', 5),
+                observation_rank=self.config.get('observation_rank')).to(self.device)
+            self.scene_net = create_scene_network(
+                self.config['action_size'], head_scenes).to(self.device)
+            if self.config.get('observation_cache', False):
+                self.shared_net.enable_observation_cache()
 
         self.checkpoints = []
         self.checkpoint_id = 0
@@ -251,13 +261,13 @@ class Evaluation:
 
     @staticmethod
     def load_checkpoints(config, fail=True):
-        evaluation = Evaluation(config)
         checkpoint_path = config.get(
             'checkpoint_path', 'model/checkpoint-{checkpoint}.pth')
 
         checkpoints = []
+        head_scenes = None
         (base_name, chk_numbers) = find_restore_points(checkpoint_path, fail)
-        if evaluation.method != "random":
+        if config['method'] != "random":
             try:
                 for chk_name in base_name:
                     state = torch.load(
@@ -266,6 +276,14 @@ class Evaluation:
             except Exception as e:
                 print("Error loading", e)
                 exit()
+            # Rank of the observation layer of compressed checkpoints (see compress_checkpoint.py)
+            if 'observation_rank' not in config and checkpoints:
+                config['observation_rank'] = checkpoints[0].get(
+                    'config', dict()).get('observation_rank')
+            # Scenes of the per-scene heads (see MultiSceneNetwork)
+            if checkpoints:
+                head_scenes = checkpoints[0].get('navigation/scenes')
+        evaluation = Evaluation(config, head_scenes)
         evaluation.saver = TrainingSaver(evaluation.shared_net,
                                          evaluation.scene_net, None, evaluation.config)
         evaluation.chk_numbers = chk_numbers
@@ -281,6 +299,7 @@ class Evaluation:
         self.checkpoint_id = (self.checkpoint_id + 1) % len(self.checkpoints)
 
     def save_video(self, ep_lengths, ep_actions, ep_start, ind_succ_or_fail_ep, chk_id, env, scene_scope, task_scope, success=True):
+        # ep_start contains the snapshot of the environment at the start of each episode
         # Find episode based on episode length
         if not ind_succ_or_fail_ep:
             return
@@ -288,7 +307,7 @@ class Evaluation:
         sorted_ep_lengths = np.sort(ep_lengths[ind_succ_or_fail_ep])
         ep_lengths_succeed = ep_lengths[ind_succ_or_fail_ep]
         ep_actions_succeed = np.array(ep_actions)[ind_succ_or_fail_ep]
-        ep_start_succeed = np.array(ep_start)[ind_succ_or_fail_ep]
+        ep_start_succeed = [ep_start[i] for i in ind_succ_or_fail_ep]
 
         ind_list = []
         names_video = []
@@ -340,12 +359,8 @@ class Evaluation:
             FPS = 5
             video = cv2.VideoWriter(
                 video_name, cv2.VideoWriter_fourcc(*"MJPG"), FPS, (width, height))
-            # Retrieve start position
-            state_id_best = ep_start_succeed[idx]
-            env.reset()
-
             # Set start position
-            env.current_state_id = state_id_best
+            env.restore(ep_start_succeed[idx])
             for a in ep_actions_succeed[idx]:
                 state, x_processed, object_mask, hidden = self.method_class.extract_input(
                     env, torch.device("cpu"))
@@ -362,7 +377,7 @@ class Evaluation:
             video.release()
 
             data = {}
-            data['start'] = ep_start_succeed[idx]
+            data['start'] = ep_start_succeed[idx].current_state_id
             data['stop'] = env.current_state_id
             data['action'] = [env.acts[i] for i in ep_actions_succeed[idx]]
             data['object_visible'] = [k.split("|")[0] for k in env.boudingbox.keys()]
@@ -409,6 +424,9 @@ class Evaluation:
             if self.method != "random":
                 self.restore()
                 self.next_checkpoint()
+                if self.quantize:
+                    quantized_network = quantize_network(
+                        Sequential(self.shared_net, self.scene_net))
             for scene_scope, items in self.config['task_list'].items():
                 if self.method != "random":
                     scene_net = self.scene_net
@@ -416,6 +434,9 @@ class Evaluation:
 
                 network = Sequential(self.shared_net, scene_net)
                 network.eval()
+                if self.method != "random" and self.quantize:
+                    network = quantized_network
+                select_scene(network, scene_scope, fallback=True)
                 scene_stats[scene_scope] = dict()
                 scene_stats[scene_scope]["length"] = list()
                 scene_stats[scene_scope]["spl"] = list()
@@ -436,18 +457,23 @@ class Evaluation:
                                                       terminal_state=task_scope,
                                                       action_size=self.config['action_size'],
                                                       mask_size=self.config.get(
-                                                          'mask_size', 5))
+                                                          'mask_size', 5),
+                                                      streaming=self.config.get('streaming', False),
+                                                      feature_dtype=self.config.get('feature_dtype', 'float32'))
 
                     ep_rewards = []
                     ep_lengths = []
                     ep_collisions = []
                     ep_actions = []
                     ep_start = []
+                    ep_snapshots = []
+                    ep_end_snapshots = []
                     ep_success = []
                     ep_spl = []
                     ep_shortest_distance = []
                     embedding_vectors = []
                     state_ids = list()
+                    policy_latency = []
 
                     ep_fail_threshold = 300
                     for i_episode in range(self.config['num_episode']):
@@ -459,13 +485,20 @@ class Evaluation:
                         ep_t = 0
                         actions = []
                         ep_start.append(env.current_state_id)
+                        ep_snapshots.append(env.snapshot())
                         while not terminal:
                             if self.method != "random":
-                                policy, value, state = self.method_class.forward_policy(
-                                    env, self.device, network)
-                                with torch.no_grad():
+                                start_time = time.perf_counter()
+                                with inference_mode():
+                                    policy, value, state = self.method_class.forward_policy(
+                                        env, self.device, network)
+                                    if self.config.get('action_mask', False):
+                                        valid_actions = torch.from_numpy(env.valid_actions())
+                                        policy = SceneSpecificNetwork.mask_policy(
+                                            policy, valid_actions.to(self.device))
                                     action = F.softmax(policy, dim=0).multinomial(
                                         1).data.cpu().numpy()[0]
+                                policy_latency.append(time.perf_counter() - start_time)
 
                                 if env.current_state_id not in state_ids:
                                     state_ids.append(env.current_state_id)
@@ -484,6 +517,7 @@ class Evaluation:
                             ep_t += 1
 
                         ep_actions.append(actions)
+                        ep_end_snapshots.append(env.snapshot())
                         ep_lengths.append(ep_t)
                         ep_rewards.append(ep_reward)
                         ep_shortest_distance.append(env.shortest_path_terminal(
@@ -532,6 +566,9 @@ class Evaluation:
 
                     ep_spl_mean = np.sum(ep_spl[ind_succeed_ep]) / self.config['num_episode']
                     log.write('episode SPL: %.3f' % ep_spl_mean)
+                    if policy_latency:
+                        log.write('mean policy latency: %.3f ms' %
+                                  (1000.0 * np.mean(policy_latency)))
 
                     # Stat on long path
                     ind_succeed_far_start = []
@@ -570,7 +607,7 @@ class Evaluation:
                     # Show best episode from evaluation
                     # We will log.write the best (lowest step), median, and worst
                     if show:
-                        self.save_video(ep_lengths, ep_actions, ep_start, ind_succeed_ep, chk_id, env, scene_scope, task_scope)
+                        self.save_video(ep_lengths, ep_actions, ep_snapshots, ind_succeed_ep, chk_id, env, scene_scope, task_scope)
                     
                     # Save failed episode
                     ind_failed_ep = [
@@ -604,11 +641,8 @@ class Evaluation:
                     
                     ep_done_visible = 0
                     for i in ind_done:
-                        env.reset()
-                        # Set start position
-                        env.current_state_id = ep_start[i]
-                        for a in ep_actions[i]:
-                            env.step(a)
+                        # Go back to the end of the episode
+                        env.restore(ep_end_snapshots[i])
                         objects = [k.split("|")[0] for k in env.boudingbox.keys()]
                         if task_scope['object'] in objects:
                             ep_done_visible += 1
@@ -640,14 +674,14 @@ class Evaluation:
                         if len(ep_failed_selec) > nb_fail:
                             ep_failed_selec = random.sample(ind_lost, nb_fail)
 
-                        self.save_video(ep_lengths, ep_actions, ep_start, ep_failed_selec, chk_id, env, scene_scope, task_scope, success=False)
+                        self.save_video(ep_lengths, ep_actions, ep_snapshots, ep_failed_selec, chk_id, env, scene_scope, task_scope, success=False)
                         
                         # Get random 5 done
                         ep_failed_selec = ind_done
                         if len(ep_failed_selec) > nb_fail:
                             ep_failed_selec = random.sample(ind_done, nb_fail)
 
-                        self.save_video(ep_lengths, ep_actions, ep_start, ep_failed_selec, chk_id, env, scene_scope, task_scope, success=False)
+                        self.save_video(ep_lengths, ep_actions, ep_snapshots, ep_failed_selec, chk_id, env, scene_scope, task_scope, success=False)
 
             log.write('\nResults (average trajectory length):')
             for scene_scope in scene_stats:
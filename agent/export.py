@@ -0,0 +1,113 @@
+import copy
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from agent.network import GCN, MultiSceneNetwork
+from agent.numpy_policy import NUMPY_POLICY_INPUTS
+from agent.policy_runner import POLICY_INPUTS, render_input
+
+
+def _check_exportable(network):
+    # Exported policies have no scene input, the head of a scene would be fixed
+    if any(isinstance(module, MultiSceneNetwork) for module in network.modules()):
+        raise Exception('Networks with one policy head per scene can not be exported')
+
+
+class ExportedPolicy(nn.Module):
+    """nn.Sequential(SharedNetwork, SceneSpecificNetwork) with one tensor per input
+
+    Inputs are the tensors of POLICY_INPUTS[method] for a single state.
+    Outputs are the policy logits and the value, followed by the new hidden
+    state for recurrent methods.
+    """
+
+    def __init__(self, network, inputs):
+        super(ExportedPolicy, self).__init__()
+        self.network = network
+        self.recurrent = 'hidden' in inputs
+        self.n_hidden = len([name for name in inputs if name in ('hidden', 'cell')])
+
+    def forward(self, *inputs):
+        if not self.recurrent:
+            return self.network(tuple(inputs))
+
+        # Recurrent networks return their new hidden state, see SimilarityGrid.forward_policy
+        hidden = inputs[2:]
+        (x, hidden) = self.network[0](
+            (inputs[0], inputs[1], tuple(hidden) if self.n_hidden > 1 else hidden[0]))
+        (policy, value) = self.network[1](x)
+        return (policy, value) + (tuple(hidden) if self.n_hidden > 1 else (hidden,))
+
+
+def export_policy(network, method, env, path, action_size):
+    """Trace a network on the inputs of env and save it with torch.jit
+
+    The trace fixes the shape of every input (history length, mask size,
+    hidden size). The target caches are removed from the traced copy so that
+    the target stays an input of the policy, gcn uses its dense adjacency.
+
+    Arguments:
+        network {nn.Sequential} -- SharedNetwork and SceneSpecificNetwork of a checkpoint
+        method {str} -- Method of the network
+        env {THORDiscreteEnvironment} -- Environment giving the example inputs
+        path {str} -- Output file
+        action_size {int} -- Number of actions of the policy
+
+    Returns:
+        dict -- Description saved with the policy (method, inputs, action_size)
+    """
+    if method not in POLICY_INPUTS:
+        raise Exception('Method ' + method + ' can not be exported')
+    _check_exportable(network)
+    inputs = list(POLICY_INPUTS[method])
+    # gcn runs resnet50 on the observation when the scores are not in the dataset
+    if 'resnet_score' in inputs and env.render_resnet_score_tensor('cpu') is None:
+        inputs[inputs.index('resnet_score')] = 'rgb'
+
+    network = copy.deepcopy(network).cpu()
+    network.eval()
+    for module in network.modules():
+        if getattr(module, 'target_cache', None) is not None:
+            module.target_cache = None
+        # Sparse tensors can not be traced as constants
+        if isinstance(module, GCN):
+            module.sparse_adjacency = False
+    policy = ExportedPolicy(network, inputs)
+
+    example_inputs = tuple(render_input(env, name, 'cpu') for name in inputs)
+    with torch.no_grad():
+        # Caches of constant inputs (gcn word embeddings) are filled before the
+        # trace so that their output is kept as a constant
+        policy(*example_inputs)
+        traced = torch.jit.trace(policy, example_inputs)
+
+    description = {'method': method, 'inputs': inputs, 'action_size': action_size,
+                   'shapes': [list(x.shape) for x in example_inputs]}
+    torch.jit.save(traced, path, _extra_files={'policy.json': json.dumps(description)})
+    return description
+
+
+def export_numpy_policy(network, method, path, action_size):
+    """Save the weights of a feedforward network for NumpyPolicy
+
+    Arguments:
+        network {nn.Sequential} -- SharedNetwork and SceneSpecificNetwork of a checkpoint
+        method {str} -- Method of the network, one of NUMPY_POLICY_INPUTS
+        path {str} -- Output .npz file
+        action_size {int} -- Number of actions of the policy
+
+    Returns:
+        dict -- Description saved with the weights (method, inputs, action_size)
+    """
+    if method not in NUMPY_POLICY_INPUTS:
+        raise Exception('Method ' + method + ' can not be exported to numpy')
+    _check_exportable(network)
+    description = {'method': method, 'inputs': NUMPY_POLICY_INPUTS[method],
+                   'action_size': action_size}
+    weights = {name: tensor.detach().cpu().numpy()
+               for name, tensor in network.state_dict().items()}
+    np.savez(path, __policy__=np.array(json.dumps(description)), **weights)
+    return description
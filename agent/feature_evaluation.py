@@ -24,7 +24,7 @@ from agent.method.aop import AOP
 from agent.method.gcn import GCN
 from agent.method.similarity_grid import SimilarityGrid
 from agent.method.target_driven import TargetDriven
-from agent.network import SceneSpecificNetwork, SharedNetwork
+from agent.network import SharedNetwork, create_scene_network, select_scene
 from agent.training import TrainingSaver
 from agent.utils import find_restore_points, get_first_free_gpu
 from torchvision import transforms
@@ -34,16 +34,19 @@ mpl_logger.setLevel(logging.WARNING)
 
 
 class FeatureEvaluation:
-    def __init__(self, config):
+    def __init__(self, config, head_scenes=None):
         self.config = config
         self.method = config['method']
         gpu_id = get_first_free_gpu(2000)
         self.device = torch.device("cuda:" + str(gpu_id))
         if self.method != "random":
             self.shared_net = SharedNetwork(
-                self.config['method'], self.config.get('mask_size', 5)).to(self.device)
-            self.scene_net = SceneSpecificNetwork(
-                self.config['action_size']).to(self.device)
+                self.config['method'], self.config.get('mask_size', 5),
+                observation_rank=self.config.get('observation_rank')).to(self.device)
+            self.scene_net = create_scene_network(
+                self.config['action_size'], head_scenes).to(self.device)
+            # Grad-CAM needs the similarity grid convolution and its gradients
+            self.shared_net.enable_gradient_capture()
 
         self.checkpoints = []
         self.checkpoint_id = 0
@@ -52,13 +55,13 @@ class FeatureEvaluation:
 
     @staticmethod
     def load_checkpoints(config, fail=True):
-        evaluation = FeatureEvaluation(config)
         checkpoint_path = config.get(
             'checkpoint_path', 'model/checkpoint-{checkpoint}.pth')
 
         checkpoints = []
+        head_scenes = None
         (base_name, chk_numbers) = find_restore_points(checkpoint_path, fail)
-        if evaluation.method != "random":
+        if config['method'] != "random":
             try:
                 for chk_name in base_name:
                     state = torch.load(
@@ -67,6 +70,11 @@ class FeatureEvaluation:
             except Exception as e:
                 print("Error loading", e)
                 exit()
+            # Scenes of the per-scene heads (see MultiSceneNetwork)
+            if checkpoints:
+                head_scenes = checkpoints[0].get('navigation/scenes')
+        evaluation = FeatureEvaluation(config, head_scenes)
+        if evaluation.method != "random":
             evaluation.saver = TrainingSaver(evaluation.shared_net,
                                              evaluation.scene_net, None, evaluation.config)
         evaluation.chk_numbers = chk_numbers
@@ -99,6 +107,7 @@ class FeatureEvaluation:
             scene_stats = dict()
             for scene_scope, items in self.config['task_list'].items():
                 self.restore()
+                select_scene(self.scene_net, scene_scope, fallback=True)
                 scene_stats[scene_scope] = dict()
                 scene_stats[scene_scope]["length"] = list()
                 scene_stats[scene_scope]["spl"] = list()
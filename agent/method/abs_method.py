@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 
+import torch.nn as nn
+
 
 class AbstractMethod(ABC):
 
@@ -12,5 +14,20 @@ class AbstractMethod(ABC):
         pass
 
     @abstractmethod
-    def extract_input(self, env, device):
+    def extract_input(self, env, device, policy_networks=None):
         pass
+
+    def render_observation(self, env, device, policy_networks=None):
+        """Stacked history given to the network
+
+        When the shared network has an observation cache and is in eval mode,
+        the output of its observation layer is computed from the cache instead.
+        """
+        shared_network = policy_networks[0] if isinstance(policy_networks, nn.Sequential) else None
+        cache = getattr(shared_network, 'observation_cache', None)
+        if cache is not None and not shared_network.training:
+            frames, keys = env.history.chronological()
+            projection = cache(frames, keys, env.scene)
+            projection.value = projection.value.to(device)
+            return projection
+        return env.render_tensor('resnet_features', device)
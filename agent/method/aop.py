@@ -4,25 +4,23 @@ from .abs_method import AbstractMethod
 
 
 class AOP(AbstractMethod):
-    def extract_input(self, env, device):
+    def extract_input(self, env, device, policy_networks=None):
         state = {
             "current": env.render('resnet_features'),
             "goal": env.render_target('word_features'),
             "object_mask": env.render_mask()
         }
-        x_processed = torch.from_numpy(state["current"])
-        goal_processed = torch.from_numpy(state["goal"])
+        x_processed = self.render_observation(env, device, policy_networks)
+        goal_processed = env.render_target_tensor('word_features', device)
         object_mask = torch.from_numpy(state['object_mask'])
 
-        x_processed = x_processed.to(device)
-        goal_processed = goal_processed.to(device)
         object_mask = object_mask.to(device)
 
         return state, x_processed, goal_processed, object_mask
 
     def forward_policy(self, env, device, policy_networks):
 
-        state, x_processed, goal_processed, object_mask = self.extract_input(env, device)
+        state, x_processed, goal_processed, object_mask = self.extract_input(env, device, policy_networks)
 
         if self.method == 'aop' or self.method == 'aop_we':
             (policy, value) = policy_networks(
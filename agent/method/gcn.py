@@ -4,32 +4,34 @@ from torchvision import transforms
 
 from .abs_method import AbstractMethod
 
+# Input transform of the pretrained ResNet-50
+normalize = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[
+        0.229, 0.224, 0.225])])
+
 
 class GCN(AbstractMethod):
-    def extract_input(self, env, device):
-        normalize = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[
-                0.229, 0.224, 0.225])])
+    def extract_input(self, env, device, policy_networks=None):
         state = {
             "current": env.render('resnet_features'),
             "goal": env.render_target('word_features'),
-            "observation": normalize(env.observation).unsqueeze(0),
         }
 
-        x_processed = torch.from_numpy(state["current"])
-        goal_processed = torch.from_numpy(state["goal"])
-        obs = state['observation']
+        x_processed = self.render_observation(env, device, policy_networks)
+        goal_processed = env.render_target_tensor('word_features', device)
 
-        x_processed = x_processed.to(device)
-        goal_processed = goal_processed.to(device)
-        obs = obs.to(device)
+        # Precomputed resnet50 scores if the dataset has them (see
+        # create_resnet_score.py), otherwise the normalized observation
+        obs = env.render_resnet_score_tensor(device)
+        if obs is None:
+            obs = normalize(env.observation).unsqueeze(0).to(device)
 
         return state, x_processed, goal_processed, obs
 
     def forward_policy(self, env, device, policy_networks):
 
-        state, x_processed, goal_processed, obs = self.extract_input(env, device)
+        state, x_processed, goal_processed, obs = self.extract_input(env, device, policy_networks)
 
         (policy, value) = policy_networks(
             (x_processed, goal_processed, obs,))
@@ -1,43 +1,41 @@
 import torch
 
+from agent.network import detach_hidden
+
 from .abs_method import AbstractMethod
 
 
 class SimilarityGrid(AbstractMethod):
 
-    def extract_input(self, env, device):
+    def extract_input(self, env, device, policy_networks=None):
         state = {
-            "current": env.render('resnet_features'),
             "goal": env.render_target('word_features')
         }
 
         if self.method == 'word2vec' or self.method == 'word2vec_noconv':
+            state["current"] = env.render('resnet_features')
             state["object_mask"] = env.render_mask_similarity()
-            x_processed = torch.from_numpy(state["current"])
-            goal_processed = torch.from_numpy(state["goal"])
+            x_processed = self.render_observation(env, device, policy_networks)
+            goal_processed = env.render_target_tensor('word_features', device)
             object_mask = torch.from_numpy(state['object_mask'])
 
-            x_processed = x_processed.to(device)
-            goal_processed = goal_processed.to(device)
             object_mask = object_mask.to(device)
 
             return state, x_processed, goal_processed, object_mask
         elif self.method == 'word2vec_notarget':
+            state["current"] = env.render('resnet_features')
             state["object_mask"] = env.render_mask_similarity()
-            x_processed = torch.from_numpy(state["current"])
+            x_processed = self.render_observation(env, device, policy_networks)
             object_mask = torch.from_numpy(state['object_mask'])
 
-            x_processed = x_processed.to(device)
             object_mask = object_mask.to(device)
 
             return state, x_processed, object_mask
 
         elif self.method == 'word2vec_nosimi':
-            x_processed = torch.from_numpy(state["current"])
-            goal_processed = torch.from_numpy(state["goal"])
-
-            x_processed = x_processed.to(device)
-            goal_processed = goal_processed.to(device)
+            state["current"] = env.render('resnet_features')
+            x_processed = self.render_observation(env, device, policy_networks)
+            goal_processed = env.render_target_tensor('word_features', device)
 
             return state, x_processed, goal_processed
 
@@ -45,13 +43,12 @@ class SimilarityGrid(AbstractMethod):
             state["object_mask"] = env.render_mask_similarity()
             state["hidden"] = env.render_hidden_state()
             
-            # Change current state with only last frame
-            state["current"] = state["current"][:, -1]
-            x_processed = torch.from_numpy(state["current"])
+            # Change current state with only last frame, copied from the ring buffer
+            state["current"] = env.history.last().copy()
+            x_processed = env.render_last_frame(device)
             object_mask = torch.from_numpy(state['object_mask'])
             h1, c1 = state['hidden']
 
-            x_processed = x_processed.to(device)
             object_mask = object_mask.to(device)
             h1 = h1.to(device)
             c1 = c1.to(device)
@@ -63,13 +60,12 @@ class SimilarityGrid(AbstractMethod):
             state["object_mask"] = env.render_mask_similarity()
             state["hidden"] = env.render_hidden_state()
             
-            # Change current state with only last frame
-            state["current"] = state["current"][:, -1]
-            x_processed = torch.from_numpy(state["current"])
+            # Change current state with only last frame, copied from the ring buffer
+            state["current"] = env.history.last().copy()
+            x_processed = env.render_last_frame(device)
             object_mask = torch.from_numpy(state['object_mask'])
             h1 = state['hidden']
 
-            x_processed = x_processed.to(device)
             object_mask = object_mask.to(device)
             h1 = h1.to(device)
             hidden = h1
@@ -79,33 +75,24 @@ class SimilarityGrid(AbstractMethod):
 
     def forward_policy(self, env, device, policy_networks):
         if self.method == 'word2vec' or self.method == 'word2vec_noconv':
-            state, x_processed, goal_processed, object_mask = self.extract_input(env, device)
+            state, x_processed, goal_processed, object_mask = self.extract_input(env, device, policy_networks)
             (policy, value) = policy_networks((x_processed, goal_processed, object_mask,))
 
         elif self.method == 'word2vec_notarget':
-            state, x_processed, object_mask = self.extract_input(env, device)
+            state, x_processed, object_mask = self.extract_input(env, device, policy_networks)
             (policy, value) = policy_networks((x_processed, object_mask,))
 
         elif self.method == 'word2vec_nosimi':
-            state, x_processed, goal_processed = self.extract_input(env, device)
+            state, x_processed, goal_processed = self.extract_input(env, device, policy_networks)
             (policy, value) = policy_networks((x_processed, goal_processed,))
 
         elif self.method == 'word2vec_notarget_lstm' or self.method == 'word2vec_notarget_lstm_2layer' or self.method == 'word2vec_notarget_lstm_3layer' or self.method == 'word2vec_notarget_rnn' or self.method == 'word2vec_notarget_gru':
-            state, x_processed, object_mask, hidden = self.extract_input(env, device)
-
-            # Save current hidden value
-            outputs= []
-            hiddens = []
-            def hook(module, input, output):
-                outputs.append(output[0])
-                hiddens.append(output[1])
-
-            handle = policy_networks[0].net.lstm.register_forward_hook(hook)
-            (policy, value) = policy_networks((x_processed, object_mask, hidden))
-            handle.remove()
-            if self.method == 'word2vec_notarget_rnn' or self.method == 'word2vec_notarget_gru':
-                env.set_hidden(hiddens[-1].detach())
-            else:
-                env.set_hidden(tuple([h.detach() for h in hiddens[-1]]))
+            state, x_processed, object_mask, hidden = self.extract_input(env, device, policy_networks)
+
+            (x, hidden) = policy_networks[0]((x_processed, object_mask, hidden))
+            (policy, value) = policy_networks[1](x)
+            # Save current hidden value, the rollout is run again as one
+            # sequence for backpropagation through time (see TrainingThread)
+            env.set_hidden(detach_hidden(hidden))
 
         return policy, value, state
@@ -1,25 +1,20 @@
-import torch
-
 from .abs_method import AbstractMethod
 
 
 class TargetDriven(AbstractMethod):
-    def extract_input(self, env, device):
+    def extract_input(self, env, device, policy_networks=None):
         state = {
             "current": env.render('resnet_features'),
             "goal": env.render_target('resnet_features'),
         }
 
-        x_processed = torch.from_numpy(state["current"])
-        goal_processed = torch.from_numpy(state["goal"])
-
-        x_processed = x_processed.to(device)
-        goal_processed = goal_processed.to(device)
+        x_processed = self.render_observation(env, device, policy_networks)
+        goal_processed = env.render_target_tensor('resnet_features', device)
 
         return state, x_processed, goal_processed
 
     def forward_policy(self, env, device, policy_networks):
-        state, x_processed, goal_processed = self.extract_input(env, device)
+        state, x_processed, goal_processed = self.extract_input(env, device, policy_networks)
 
         (policy, value) = policy_networks(
             (x_processed, goal_processed,))
@@ -1,5 +1,8 @@
+import copy
 import json
 import math
+import os
+from collections import OrderedDict
 
 import h5py
 import numpy as np
@@ -27,6 +30,349 @@ def compare_models(model_1, model_2):
         print('Models match perfectly! :)')
 
 
+def batch_size(x, sample_dim):
+    """Leading batch size of x, None if x is a single sample
+
+    Networks accept a single sample (as given by the environment) or a batch
+    of samples stacked on a new first dimension.
+
+    Arguments:
+        x {torch.Tensor} -- Input of a network
+        sample_dim {int} -- Number of dimensions of a single sample
+    """
+    return x.size(0) if x.dim() > sample_dim else None
+
+
+def unbatch(x, n):
+    """Remove the batch dimension added to a single sample"""
+    return x if n is not None else x[0]
+
+
+def tensor_version(x):
+    """Version counter of x, increased by in-place updates (0 for inference tensors)"""
+    try:
+        return x._version
+    except RuntimeError:
+        return 0
+
+
+def layer_version(layer):
+    """Changes when the parameters of layer are updated in place (optimizer step, load_state_dict) or moved"""
+    # In-place updates of a parameter increase its version counter
+    return tuple((p.data_ptr(), p._version) for p in layer.parameters())
+
+
+class LowRankLinear(nn.Module):
+    """Linear layer with a rank r weight, up(down(x))
+
+    Used as observation layer when observation_rank is set: a [out, in]
+    weight becomes [r, in] and [out, r] weights. weight and bias give the
+    equivalent dense layer (used by ObservationCache).
+    """
+
+    def __init__(self, in_features, out_features, rank):
+        super(LowRankLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    @property
+    def weight(self):
+        return torch.mm(self.up.weight, self.down.weight)
+
+    @property
+    def bias(self):
+        return self.up.bias
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+    @staticmethod
+    def factorize(weight, rank):
+        """Truncated SVD of a dense [out, in] weight
+
+        Returns:
+            tuple -- down [rank, in] and up [out, rank] weights, up @ down is the best rank approximation
+        """
+        (u, s, v) = torch.svd(weight)
+        scale = s[:rank].sqrt()
+        return (v[:, :rank] * scale).t().contiguous(), (u[:, :rank] * scale).contiguous()
+
+
+def observation_linear(in_features, out_features, rank=None):
+    """Observation layer, low-rank when rank is set"""
+    if rank is None:
+        return nn.Linear(in_features, out_features)
+    return LowRankLinear(in_features, out_features, rank)
+
+
+def factorize_observation_layer(state_dict, method, rank):
+    """State dict of a SharedNetwork for a SharedNetwork with observation_rank=rank
+
+    The observation layer of state_dict is dense or already low-rank, the
+    product of its low-rank weights is then factorized to the new rank.
+
+    Arguments:
+        state_dict {dict} -- SharedNetwork state dict, 'net.' keys
+        method {str} -- Method of the network
+        rank {int} -- Rank of the observation layer
+    """
+    state_dict = OrderedDict(state_dict)
+    name = 'net.fc_siemense' if method == 'target_driven' else 'net.fc_observation'
+    if name + '.down.weight' in state_dict:
+        weight = torch.mm(state_dict.pop(name + '.up.weight'), state_dict.pop(name + '.down.weight'))
+        bias = state_dict.pop(name + '.up.bias')
+    else:
+        weight = state_dict.pop(name + '.weight')
+        bias = state_dict.pop(name + '.bias')
+    (down, up) = LowRankLinear.factorize(weight, rank)
+    state_dict[name + '.down.weight'] = down
+    state_dict[name + '.up.weight'] = up
+    state_dict[name + '.up.bias'] = bias
+    return state_dict
+
+
+class ProjectedObservation:
+    """Output of the observation layer computed by ObservationCache
+
+    Given to a network instead of the stacked history, value is
+    [out_features] or [batch, out_features].
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+def observation_layer(layer, x):
+    """Observation layer applied to the stacked history x
+
+    Returns:
+        tuple -- [batch or 1, out_features] output before activation and the batch size (see batch_size)
+    """
+    if isinstance(x, ProjectedObservation):
+        n = batch_size(x.value, 1)
+        return x.value.reshape(n or 1, -1), n
+    n = batch_size(x, 2)
+    return layer(x.reshape(n or 1, -1)), n
+
+
+class ObservationCache:
+    """Per frame products of the observation layer with a stacked history
+
+    The weight of the observation layer is made of one [out_features,
+    feature_size] block per position in the history, the output for a
+    history is the bias plus the product of each frame with the block of its
+    position. Products are kept by frame key and position and only computed
+    when first needed: a new frame costs one block product at the newest
+    position, and one more each time the history shifts it to a position it
+    never had. A frame thus costs at most history_length block products over
+    its lifetime, the cost of one dense layer call, whatever the number of
+    steps it stays in the history or of later visits of its state. A frame
+    without key costs one block product per call. Products are computed
+    again when the weights changed (load_state_dict, optimizer step).
+    """
+
+    def __init__(self, layer, history_length=4, capacity=4096):
+        """ObservationCache constructor
+
+        Arguments:
+            layer {nn.Linear} -- Observation layer, [out_features, feature_size * history_length] weight
+
+        Keyword Arguments:
+            history_length {int} -- Number of frames in the history (default: {4})
+            capacity {int} -- Maximum number of frames kept (default: {4096})
+        """
+        self.layer = layer
+        self.history_length = history_length
+        self.capacity = capacity
+        self.products = OrderedDict()
+        self.blocks = None
+        self.version = None
+
+    def clear(self):
+        self.products.clear()
+        self.blocks = None
+        self.version = None
+
+    def _weight_version(self):
+        return layer_version(self.layer)
+
+    def _block_product(self, frame, position):
+        if self.blocks is None:
+            weight = self.layer.weight.detach()
+            # [history_length, feature_size, out_features]
+            self.blocks = weight.view(weight.size(0), -1, self.history_length) \
+                .permute(2, 1, 0).contiguous()
+        frame = torch.from_numpy(np.ascontiguousarray(frame)).to(self.blocks)
+        return torch.matmul(frame, self.blocks[position])
+
+    def __call__(self, frames, keys, namespace=None):
+        """Output of the observation layer (before activation) for a history
+
+        Arguments:
+            frames {np.ndarray} -- [history_length, feature_size] frames, oldest first
+            keys {np.ndarray} -- [history_length] key of each frame, -1 if unknown
+
+        Keyword Arguments:
+            namespace -- Scope of the keys, e.g. the scene name (default: {None})
+
+        Returns:
+            ProjectedObservation -- [out_features] output
+        """
+        version = self._weight_version()
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+        with torch.no_grad():
+            rows = []
+            for position, (frame, key) in enumerate(zip(frames, keys.tolist())):
+                if key == -1:
+                    rows.append(self._block_product(frame, position))
+                    continue
+                # Product with the block of each position, None until needed
+                products = self.products.get((namespace, key))
+                if products is None:
+                    products = [None] * self.history_length
+                    self.products[(namespace, key)] = products
+                    if len(self.products) > self.capacity:
+                        self.products.popitem(last=False)
+                else:
+                    self.products.move_to_end((namespace, key))
+                if products[position] is None:
+                    products[position] = self._block_product(frame, position)
+                rows.append(products[position])
+            value = torch.stack(rows).sum(0) + self.layer.bias.detach()
+        return ProjectedObservation(value)
+
+
+class TargetCache:
+    """Output of a target layer (with ReLU) for the targets of the environments
+
+    The target of an environment (or any other constant input such as the
+    word embeddings of gcn) does not change, the layer is only applied
+    again when its weights changed. With autograd the output is kept with
+    its graph, every step of a rollout then shares the same node and the
+    gradients of the layer are accumulated once by the backward pass. A
+    graph can only be backpropagated once: the cache must be cleared before
+    each rollout (see clear_target_caches), as TrainingThread does when it
+    synchronizes its network.
+    """
+
+    def __init__(self, layer, capacity=64, flatten=True, activation=F.relu):
+        """TargetCache constructor
+
+        Arguments:
+            layer {nn.Linear} -- Target layer
+
+        Keyword Arguments:
+            capacity {int} -- Maximum number of target kept (default: {64})
+            flatten {bool} -- Reshape the target to [1, -1] before the layer (default: {True})
+            activation {callable} -- Applied to the layer output, None for no activation (default: {F.relu})
+        """
+        self.layer = layer
+        self.capacity = capacity
+        self.flatten = flatten
+        self.activation = activation
+        self.outputs = OrderedDict()
+        self.version = None
+
+    def __getstate__(self):
+        # Outputs are computed again by the copy of the network
+        state = self.__dict__.copy()
+        state['outputs'] = OrderedDict()
+        state['version'] = None
+        return state
+
+    def clear(self):
+        self.outputs.clear()
+        self.version = None
+
+    def _weight_version(self):
+        return layer_version(self.layer)
+
+    def _project(self, y):
+        output = self.layer(y.reshape(1, -1) if self.flatten else y)
+        if self.activation is not None:
+            output = self.activation(output)
+        return output
+
+    def __call__(self, y):
+        """Activation of the layer output for the target y ([1, out_features] when flattened)"""
+        version = self._weight_version()
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+        # The target is kept with its output so that its id is not reused
+        key = (id(y), tensor_version(y))
+        entry = self.outputs.get(key)
+        grad = torch.is_grad_enabled()
+        # An output computed without autograd has no graph to the layer
+        if entry is None or entry[0] is not y or (grad and not entry[2]):
+            entry = (y, self._project(y), grad)
+            self.outputs[key] = entry
+            if len(self.outputs) > self.capacity:
+                self.outputs.popitem(last=False)
+        else:
+            self.outputs.move_to_end(key)
+        return entry[1]
+
+
+def clear_target_caches(network):
+    """Clear the target caches of network, their outputs and graphs are computed again"""
+    for module in network.modules():
+        for name in ['target_cache', 'word_cache']:
+            cache = getattr(module, name, None)
+            if cache is not None:
+                cache.clear()
+
+
+def target_layer(layer, y, n, cache=None):
+    """ReLU of the target layer for the target y, from cache for a single target"""
+    if cache is not None and n is None:
+        return cache(y)
+    return F.relu(layer(y.reshape(n or 1, -1)), True)
+
+
+class GradientCapture:
+    """Opt-in capture of the similarity grid convolution for Grad-CAM
+
+    Disabled by default so that the forward pass does not create extra
+    autograd nodes or hooks. When enabled, the forward keeps the output of
+    conv1 in conv_output and its gradient in gradient, and the gradient with
+    respect to the similarity grid is kept in gradient_vanilla.
+    """
+
+    def save_gradient(self, grad):
+        self.gradient = grad
+
+    def hook_backward(self, module, grad_input, grad_output):
+        self.gradient_vanilla = grad_input[0]
+
+    def enable_gradient_capture(self, enabled=True):
+        self.capture_gradient = enabled
+        if enabled and self.backward_hook is None:
+            self.backward_hook = self.conv1.register_backward_hook(self.hook_backward)
+        elif not enabled and self.backward_hook is not None:
+            self.backward_hook.remove()
+            self.backward_hook = None
+
+    def _similarity_conv(self, z):
+        # [batch or 1, 1, mask_size, mask_size] for a single sample ([1, 1, mask_size, mask_size])
+        # or a batch of samples stacked on a new first dimension
+        z = z.reshape((-1,) + z.shape[-3:])
+        if not self.capture_gradient:
+            return self.conv1(z)
+        z = torch.autograd.Variable(z, requires_grad=True)
+        z = self.conv1(z)
+        z.register_hook(self.save_gradient)
+        self.conv_output = z
+        return z
+
+
 class DQN(nn.Module):
     def __init__(self):
         super(DQN, self).__init__()
@@ -45,22 +391,29 @@ class DQN(nn.Module):
         return self.head(x.view(x.size(0), -1))
 
 
-class word2vec(nn.Module):
+class word2vec(GradientCapture, nn.Module):
     """word2vec network (Our method with word embedding as target)
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(word2vec, self).__init__()
+
+        self.gradient = None
+        self.gradient_vanilla = None
+        self.conv_output = None
+        self.capture_gradient = False
+        self.backward_hook = None
+
         self.word_embedding_size = 300
         self.fc_target = nn.Linear(
             self.word_embedding_size, self.word_embedding_size)
+        self.target_cache = TargetCache(self.fc_target)
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
 
         # Convolution for similarity grid
         pooling_kernel = 2
         self.conv1 = nn.Conv2d(1, 8, 3, stride=1)
-        # self.conv1.register_backward_hook(self.hook_backward)
         self.pool = nn.MaxPool2d(pooling_kernel, pooling_kernel)
         self.conv2 = nn.Conv2d(8, 16, 5, stride=1)
 
@@ -77,41 +430,35 @@ class word2vec(nn.Module):
         # y is the target
         # z is the object location mask
         (x, y, z) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
 
-        y = y.view(-1)
-        y = self.fc_target(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_target, y, n, self.target_cache)
 
-        z = torch.autograd.Variable(z, requires_grad=True)
-        z = self.conv1(z)
-        z.register_hook(self.save_gradient)
-        self.conv_output = z
+        z = self._similarity_conv(z)
         z = self.pool(F.relu(z))
         z = self.pool(F.relu(self.conv2(z)))
-        z = z.view(-1)
+        z = z.reshape(n or 1, -1)
 
         # xy = torch.stack([x, y], 0).view(-1)
-        xyz = torch.cat([x, y, z])
+        xyz = torch.cat([x, y, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        return xyz
+        return unbatch(xyz, n)
 
 
 class word2vec_noconv(nn.Module):
     """Our method network without convolution for similarity grid
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(word2vec_noconv, self).__init__()
         self.word_embedding_size = 300
         self.fc_target = nn.Linear(
             self.word_embedding_size, self.word_embedding_size)
+        self.target_cache = TargetCache(self.fc_target)
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
 
         self.flat_input = mask_size * mask_size
         self.fc_similarity = nn.Linear(self.flat_input, self.flat_input)
@@ -125,51 +472,42 @@ class word2vec_noconv(nn.Module):
         # y is the target
         # z is the object location mask
         (x, y, z) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
 
-        y = y.view(-1)
-        y = self.fc_target(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_target, y, n, self.target_cache)
 
-        z = z.view(-1)
+        z = z.reshape(n or 1, -1)
         z = self.fc_similarity(z)
         z = F.relu(z, True)
 
         # xy = torch.stack([x, y], 0).view(-1)
-        xyz = torch.cat([x, y, z])
+        xyz = torch.cat([x, y, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        return xyz
+        return unbatch(xyz, n)
 
 
-class word2vec_notarget(nn.Module):
+class word2vec_notarget(GradientCapture, nn.Module):
     """Our method network without target word embedding
     """
 
-    def save_gradient(self, grad):
-        self.gradient = grad
-
-    def hook_backward(self, module, grad_input, grad_output):
-        self.gradient_vanilla = grad_input[0]
-
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(word2vec_notarget, self).__init__()
 
         self.gradient = None
         self.gradient_vanilla = None
         self.conv_output = None
         self.output_context = None
+        self.capture_gradient = False
+        self.backward_hook = None
 
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
 
         # Convolution for similarity grid
         pooling_kernel = 2
         self.conv1 = nn.Conv2d(1, 8, 3, stride=1)
-        self.conv1.register_backward_hook(self.hook_backward)
         self.pool = nn.MaxPool2d(pooling_kernel, pooling_kernel)
         self.conv2 = nn.Conv2d(8, 16, 5, stride=1)
 
@@ -185,32 +523,27 @@ class word2vec_notarget(nn.Module):
         # x is the observation
         # z is the object location mask
         (x, z) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
 
-        z = torch.autograd.Variable(z, requires_grad=True)
-        z = self.conv1(z)
-        z.register_hook(self.save_gradient)
-        self.conv_output = z
+        z = self._similarity_conv(z)
         z = self.pool(F.relu(z))
         z = self.pool(F.relu(self.conv2(z)))
-        z = z.view(-1)
-        self.output_context = z
+        z = z.reshape(n or 1, -1)
+        self.output_context = unbatch(z, n)
 
         # xy = torch.stack([x, y], 0).view(-1)
-        xyz = torch.cat([x, z])
+        xyz = torch.cat([x, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        return xyz
+        return unbatch(xyz, n)
 
 
 class word2vec_notarget_lstm(nn.Module):
     """Our method network with LSTM without target word embedding 
     """
 
-    def __init__(self, method, mask_size=5, nb_layer=1, cell="lstm"):
+    def __init__(self, method, mask_size=5, nb_layer=1, cell="lstm", observation_rank=None):
         super(word2vec_notarget_lstm, self).__init__()
 
         self.gradient = None
@@ -221,7 +554,7 @@ class word2vec_notarget_lstm(nn.Module):
         self.cell = cell
 
         # Observation layer, use only last RGB frame
-        self.fc_observation = nn.Linear(2048, 512)
+        self.fc_observation = observation_linear(2048, 512, observation_rank)
 
         # Convolution for similarity grid
         pooling_kernel = 2
@@ -246,44 +579,62 @@ class word2vec_notarget_lstm(nn.Module):
             self.lstm = nn.GRU(512, 512, num_layers=nb_layer)
 
     def forward(self, inp):
+        """Features and new hidden state of the recurrent layer
+
+        x is the latest frame [2048] of a single step, or [T, 2048] /
+        [T, batch, 2048] for a sequence, z is the similarity grid of each step
+        ([1, 1, mask_size, mask_size] for a single step). hidden is the hidden
+        state before the first step, [nb_layer, batch or 1, 512] or a tuple
+        (hidden, cell) for lstm. A sequence goes through the recurrent layer
+        in one call.
+
+        Returns:
+            tuple -- [512] features ([T, 512] / [T, batch, 512] for a sequence) and the hidden state after the last step
+        """
         # x is the observation
         # z is the object location mask
         (x, z, hidden) = inp
+        steps = x.shape[:-1]
 
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        x = self.fc_observation(x.reshape(-1, x.size(-1)))
         x = F.relu(x, True)
 
-        z = torch.autograd.Variable(z, requires_grad=True)
-        z = self.conv1(z)
+        z = self.conv1(z.reshape((-1,) + z.shape[-3:]))
         z = self.pool(F.relu(z))
         z = self.pool(F.relu(self.conv2(z)))
-        z = z.view(-1)
-        self.output_context = z
+        z = z.reshape(x.size(0), -1)
+        self.output_context = z.reshape(steps + (-1,))
 
         # xy = torch.stack([x, y], 0).view(-1)
-        xyz = torch.cat([x, z])
+        xyz = torch.cat([x, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        if self.cell == "lstm":
-            out, (h1, c1) =  self.lstm(xyz.view(1, 1, -1), hidden)
-        else:
-            out, h1 = self.lstm(xyz.view(1, 1, -1), hidden)
 
-        return out.squeeze()
+        # [T, batch, 512] input of the recurrent layer
+        sequence_length = steps[0] if len(steps) > 0 else 1
+        out, hidden = self.lstm(xyz.reshape(sequence_length, -1, xyz.size(-1)), hidden)
+        return out.reshape(steps + (-1,)), hidden
+
+
+def detach_hidden(hidden):
+    """Hidden state of a recurrent network (tensor or tuple of tensors) without its graph"""
+    if isinstance(hidden, tuple):
+        return tuple(h.detach() for h in hidden)
+    return hidden.detach()
 
 
 class baseline(nn.Module):
     """Baseline network
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(baseline, self).__init__()
         self.word_embedding_size = 300
         self.fc_target = nn.Linear(
             self.word_embedding_size, self.word_embedding_size)
+        self.target_cache = TargetCache(self.fc_target)
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
         self.fc_merge = nn.Linear(self.word_embedding_size + 512, 512)
 
         self.output_resnet = None
@@ -292,33 +643,30 @@ class baseline(nn.Module):
         # x is the observation
             # y is the target
         (x, y) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
-        self.output_resnet = x
+        self.output_resnet = unbatch(x, n)
 
-        y = y.view(-1)
-        y = self.fc_target(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_target, y, n, self.target_cache)
 
-        xy = torch.cat([x, y])
+        xy = torch.cat([x, y], 1)
         xy = self.fc_merge(xy)
         xy = F.relu(xy, True)
-        return xy
+        return unbatch(xy, n)
 
 
 class aop(nn.Module):
     """AOP with image feature as target
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(aop, self).__init__()
         # Target object layer
         self.fc_target = nn.Linear(2048, 512)
+        self.target_cache = TargetCache(self.fc_target)
 
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
 
         # Merge layer
         self.fc_merge = nn.Linear(1024+(mask_size*mask_size), 512)
@@ -328,35 +676,32 @@ class aop(nn.Module):
         # y is the target
         # z is the object location mask
         (x, y, z) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
 
-        y = y.view(-1)
-        y = self.fc_target(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_target, y, n, self.target_cache)
 
-        z = z.view(-1)
+        z = z.reshape(n or 1, -1)
 
-        xy = torch.stack([x, y], 0).view(-1)
-        xyz = torch.cat([xy, z])
+        xy = torch.cat([x, y], 1)
+        xyz = torch.cat([xy, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        return xyz
+        return unbatch(xyz, n)
 
 
 class aop_we(nn.Module):
     """AOP with word embedding as target
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(aop_we, self).__init__()
         # Target object layer
         self.fc_target = nn.Linear(300, 300)
+        self.target_cache = TargetCache(self.fc_target)
 
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
 
         # Merge layer
         self.fc_merge = nn.Linear(812+(mask_size*mask_size), 512)
@@ -366,63 +711,57 @@ class aop_we(nn.Module):
             # y is the target
             # z is the object location mask
         (x, y, z) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
 
-        y = y.view(-1)
-        y = self.fc_target(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_target, y, n, self.target_cache)
 
-        z = z.view(-1)
+        z = z.reshape(n or 1, -1)
 
-        xyz = torch.cat([x, y, z])
+        xyz = torch.cat([x, y, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        return xyz
+        return unbatch(xyz, n)
 
 
 class target_driven(nn.Module):
     """Target driven using visual input as target
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(target_driven, self).__init__()
         # Siemense layer
-        self.fc_siemense = nn.Linear(8192, 512)
+        self.fc_siemense = observation_linear(8192, 512, observation_rank)
+        self.target_cache = TargetCache(self.fc_siemense)
 
         # Merge layer
         self.fc_merge = nn.Linear(1024, 512)
 
     def forward(self, inp):
         (x, y,) = inp
-
-        x = x.view(-1)
-        x = self.fc_siemense(x)
+        (x, n) = observation_layer(self.fc_siemense, x)
         x = F.relu(x, True)
 
-        y = y.view(-1)
-        y = self.fc_siemense(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_siemense, y, n, self.target_cache)
 
-        xy = torch.stack([x, y], 0).view(-1)
+        xy = torch.cat([x, y], 1)
         xy = self.fc_merge(xy)
         xy = F.relu(xy, True)
-        return xy
+        return unbatch(xy, n)
 
 
 class gcn(nn.Module):
     """GCN implementation
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(gcn, self).__init__()
         self.word_embedding_size = 300
         self.fc_target = nn.Linear(
             self.word_embedding_size, self.word_embedding_size)
+        self.target_cache = TargetCache(self.fc_target)
         # Observation layer
-        self.fc_observation = nn.Linear(8192, 512)
+        self.fc_observation = observation_linear(8192, 512, observation_rank)
 
         # GCN layer
         self.gcn = GCN()
@@ -436,63 +775,60 @@ class gcn(nn.Module):
         # y is the target
         # z is the observation (RGB frame)
         (x, y, z) = inp
-
-        x = x.view(-1)
-        x = self.fc_observation(x)
+        (x, n) = observation_layer(self.fc_observation, x)
         x = F.relu(x, True)
 
-        y = y.view(-1)
-        y = self.fc_target(y)
-        y = F.relu(y, True)
+        y = target_layer(self.fc_target, y, n, self.target_cache)
 
         z = self.gcn(z)
 
         # xy = torch.stack([x, y], 0).view(-1)
-        xyz = torch.cat([x, y, z])
+        xyz = torch.cat([x, y, z], 1)
         xyz = self.fc_merge(xyz)
         xyz = F.relu(xyz, True)
-        return xyz
+        return unbatch(xyz, n)
 
 
 class SharedNetwork(nn.Module):
     """ Bottom network, will extract feature for the policy network
     """
 
-    def __init__(self, method, mask_size=5):
+    def __init__(self, method, mask_size=5, observation_rank=None):
         super(SharedNetwork, self).__init__()
         self.method = method
         self.gradient = None
         self.gradient_vanilla = None
         self.conv_output = None
+        self.observation_cache = None
 
         if self.method == 'word2vec':
-            self.net = word2vec(method, mask_size=mask_size)
+            self.net = word2vec(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'word2vec_noconv':
-            self.net = word2vec_noconv(method, mask_size=mask_size)
+            self.net = word2vec_noconv(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'word2vec_notarget':
-            self.net = word2vec_notarget(method, mask_size=mask_size)
+            self.net = word2vec_notarget(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'word2vec_notarget_lstm':
-            self.net = word2vec_notarget_lstm(method, mask_size=mask_size)
+            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'word2vec_notarget_lstm_2layer':
-            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, nb_layer=2)
+            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, observation_rank=observation_rank, nb_layer=2)
         elif self.method == 'word2vec_notarget_lstm_3layer':
-            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, nb_layer=3)
+            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, observation_rank=observation_rank, nb_layer=3)
         elif self.method == 'word2vec_notarget_rnn':
-            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, cell='rnn')
+            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, observation_rank=observation_rank, cell='rnn')
         elif self.method == 'word2vec_notarget_gru' :
-            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, cell='gru')
+            self.net = word2vec_notarget_lstm(method, mask_size=mask_size, observation_rank=observation_rank, cell='gru')
 
         # word2vec_nosimi is the baseline
         elif self.method == "word2vec_nosimi":
-            self.net = baseline(method, mask_size=mask_size)
+            self.net = baseline(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'aop':
-            self.net = aop(method, mask_size=mask_size)
+            self.net = aop(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'aop_we':
-            self.net = aop_we(method, mask_size=mask_size)
+            self.net = aop_we(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'target_driven':
-            self.net = target_driven(method, mask_size=mask_size)
+            self.net = target_driven(method, mask_size=mask_size, observation_rank=observation_rank)
         elif self.method == 'gcn':
-            self.net = gcn(method, mask_size=mask_size)
+            self.net = gcn(method, mask_size=mask_size, observation_rank=observation_rank)
         else:
             raise Exception("Please choose a method")
 
@@ -502,13 +838,38 @@ class SharedNetwork(nn.Module):
     def hook_backward(self, module, grad_input, grad_output):
         self.gradient_vanilla = grad_input[0]
 
+    def enable_gradient_capture(self, enabled=True):
+        """Keep the similarity grid convolution output and gradients, see GradientCapture"""
+        if not isinstance(self.net, GradientCapture):
+            raise Exception(f'Gradient capture is not available for {self.method}')
+        self.net.enable_gradient_capture(enabled)
+
+    def enable_observation_cache(self, history_length=4, capacity=4096):
+        """Cache the products of the observation layer per frame, see ObservationCache
+
+        The cache is only used in eval mode, method classes then give a
+        ProjectedObservation to the network instead of the stacked history.
+        """
+        if isinstance(self.net, word2vec_notarget_lstm):
+            raise Exception('Observation cache needs a stacked history input')
+        if self.method == 'target_driven':
+            layer = self.net.fc_siemense
+        else:
+            layer = self.net.fc_observation
+        self.observation_cache = ObservationCache(layer, history_length, capacity)
+
+    @property
+    def recurrent(self):
+        """Recurrent networks take and return a hidden state, see word2vec_notarget_lstm"""
+        return isinstance(self.net, word2vec_notarget_lstm)
+
     def forward(self, inp):
         return self.net(inp)
 
 
 class SceneSpecificNetwork(nn.Module):
     """
-    Input for this network is 512 tensor
+    Input for this network is 512 tensor, or [batch, 512] for a batch
     """
 
     def __init__(self, action_space_size):
@@ -522,13 +883,175 @@ class SceneSpecificNetwork(nn.Module):
         self.fc2_value = nn.Linear(512, 1)
 
     def forward(self, x):
-        x = self.fc1(x)
+        # Layers always see a batch (quantized linear layers need one)
+        n = batch_size(x, 1)
+        x = self.fc1(x.reshape(n or 1, -1))
         x = F.relu(x)
         x_policy = self.fc2_policy(x)
         # x_policy = F.softmax(x_policy)
 
-        x_value = self.fc2_value(x)[0]
-        return (x_policy, x_value, )
+        x_value = self.fc2_value(x)[:, 0]
+        return (unbatch(x_policy, n), unbatch(x_value, n), )
+
+    @staticmethod
+    def mask_policy(policy, valid_actions):
+        """Remove invalid actions from the policy logits
+
+        A large finite value is used instead of -inf so that the entropy of the
+        masked policy stays finite.
+
+        Arguments:
+            policy {torch.Tensor} -- [action_size] policy logits, or [batch, action_size]
+            valid_actions {torch.Tensor} -- Mask of the valid actions with the shape of policy (1 valid, 0 invalid)
+        """
+        return policy.masked_fill(valid_actions == 0, -1e9)
+
+
+class MultiSceneNetwork(nn.Module):
+    """SceneSpecificNetwork with one head per scene
+
+    The fc1, fc2_policy and fc2_value layers of every scene are separate
+    parameters, so that the heads of the scenes absent from a loss get no
+    gradient and are left untouched by the optimizer (their RMSprop
+    statistics do not decay). Input is the same as SceneSpecificNetwork and
+    uses the head of the scene set by select_scene, or a tuple (x, scene_ids)
+    with the [batch] scene id of each sample: a batch may then mix scenes,
+    the heads of its scenes are stacked and the weights of each sample are
+    gathered by scene id and applied with a batched matmul, one call per layer.
+    """
+
+    def __init__(self, action_space_size, scenes):
+        """MultiSceneNetwork constructor
+
+        Arguments:
+            action_space_size {int} -- Number of actions
+            scenes {list} -- Name of the scene of each head
+        """
+        super(MultiSceneNetwork, self).__init__()
+        self.scenes = list(scenes)
+        self.scene_id = 0
+        n_scenes = len(self.scenes)
+
+        def parameters(*size):
+            return nn.ParameterList([Parameter(torch.empty(*size)) for _ in range(n_scenes)])
+
+        self.fc1_weight = parameters(512, 512)
+        self.fc1_bias = parameters(512)
+
+        # Policy layer
+        self.fc2_policy_weight = parameters(action_space_size, 512)
+        self.fc2_policy_bias = parameters(action_space_size)
+
+        # Value layer
+        self.fc2_value_weight = parameters(1, 512)
+        self.fc2_value_bias = parameters(1)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Initialization of nn.Linear for the layer of every scene
+        for (weights, biases) in [(self.fc1_weight, self.fc1_bias),
+                                  (self.fc2_policy_weight, self.fc2_policy_bias),
+                                  (self.fc2_value_weight, self.fc2_value_bias)]:
+            for (weight, bias) in zip(weights, biases):
+                nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+                bound = 1 / math.sqrt(weight.size(1))
+                nn.init.uniform_(bias, -bound, bound)
+
+    def scene_index(self, scene):
+        """Scene id of the head of scene"""
+        if scene not in self.scenes:
+            raise Exception('No policy head for scene ' + scene)
+        return self.scenes.index(scene)
+
+    def select_scene(self, scene, fallback=False):
+        """Use the head of scene when no scene ids are given
+
+        Keyword Arguments:
+            fallback {bool} -- Use the head of the first scene for a scene without head,
+                               instead of raising (default: {False})
+        """
+        if fallback and scene not in self.scenes:
+            print('No policy head for scene {}, using the head of {}'.format(scene, self.scenes[0]))
+            self.scene_id = 0
+        else:
+            self.scene_id = self.scene_index(scene)
+
+    @staticmethod
+    def stacked_linear(x, heads, index, weights, biases):
+        """Linear layer of the scene of each sample of x [batch, in_features]
+
+        Arguments:
+            heads {list} -- Scene ids of the heads used by the batch
+            index {torch.Tensor} -- [batch] position in heads of the scene of each sample
+        """
+        weight = torch.stack([weights[i] for i in heads])[index]
+        bias = torch.stack([biases[i] for i in heads])[index]
+        return torch.baddbmm(bias.unsqueeze(2), weight, x.unsqueeze(2)).squeeze(2)
+
+    def forward(self, x):
+        if isinstance(x, tuple):
+            (x, scene_ids) = x
+        else:
+            scene_ids = None
+        n = batch_size(x, 1)
+        x = x.reshape(n or 1, -1)
+        if scene_ids is None:
+            i = self.scene_id
+            x = F.relu(F.linear(x, self.fc1_weight[i], self.fc1_bias[i]))
+            x_policy = F.linear(x, self.fc2_policy_weight[i], self.fc2_policy_bias[i])
+            x_value = F.linear(x, self.fc2_value_weight[i], self.fc2_value_bias[i])[:, 0]
+        else:
+            (heads, index) = torch.unique(scene_ids, return_inverse=True)
+            heads = heads.tolist()
+            x = F.relu(self.stacked_linear(x, heads, index, self.fc1_weight, self.fc1_bias))
+            x_policy = self.stacked_linear(
+                x, heads, index, self.fc2_policy_weight, self.fc2_policy_bias)
+            x_value = self.stacked_linear(
+                x, heads, index, self.fc2_value_weight, self.fc2_value_bias)[:, 0]
+        return (unbatch(x_policy, n), unbatch(x_value, n), )
+
+
+def create_scene_network(action_space_size, scenes=None):
+    """Policy and value head, one MultiSceneNetwork head per scene when scenes is given
+
+    Arguments:
+        action_space_size {int} -- Number of actions
+
+    Keyword Arguments:
+        scenes {list} -- Scenes of the heads, None for a SceneSpecificNetwork shared by every scene (default: {None})
+    """
+    if scenes is None:
+        return SceneSpecificNetwork(action_space_size)
+    return MultiSceneNetwork(action_space_size, scenes)
+
+
+def select_scene(network, scene, fallback=False):
+    """Use the head of scene in the MultiSceneNetwork of network, no effect on a shared head
+
+    Keyword Arguments:
+        fallback {bool} -- Use the head of the first scene for a scene held out
+                           of training, instead of raising (default: {False})
+    """
+    for module in network.modules():
+        if isinstance(module, MultiSceneNetwork):
+            module.select_scene(scene, fallback)
+
+
+def quantize_network(network):
+    """Copy of a trained network with int8 dynamic quantization of its linear layers
+
+    The weights of every nn.Linear are stored as int8 and the activations are
+    quantized on the fly, for CPU inference only. The observation and target
+    caches keep the float layers of the copy, they compute each product once.
+
+    Arguments:
+        network {nn.Module} -- Trained network, it is not modified
+    """
+    if not hasattr(torch, 'quantization') or not hasattr(torch.quantization, 'quantize_dynamic'):
+        raise Exception('Dynamic quantization needs torch >= 1.3')
+    network = copy.deepcopy(network).cpu()
+    network.eval()
+    return torch.quantization.quantize_dynamic(network, {nn.Linear}, dtype=torch.qint8, inplace=True)
 
 
 class ActorCriticLoss(nn.Module):
@@ -578,8 +1101,17 @@ class GraphConvolution(nn.Module):
             self.bias.data.uniform_(-stdv, stdv)
 
     def forward(self, input, adj):
-        support = torch.mm(input, self.weight)
-        output = torch.spmm(adj, support)
+        # input is [n, in_features] or [batch, n, in_features], adj is
+        # the sparse (or dense) [n, n] adjacency
+        if input.dim() == 2:
+            support = torch.mm(input, self.weight)
+            output = torch.spmm(adj, support)
+        else:
+            # [batch, n, out] -> [n, batch * out], every graph in one product
+            support = torch.matmul(input, self.weight)
+            (batch, n, out) = support.shape
+            output = torch.spmm(adj, support.transpose(0, 1).reshape(n, -1))
+            output = output.reshape(n, batch, out).transpose(0, 1)
         if self.bias is not None:
             return output + self.bias
         else:
@@ -601,35 +1133,111 @@ def normalize_adj(adj):
     return adj.dot(d_mat_inv_sqrt).transpose().dot(d_mat_inv_sqrt).tocoo()
 
 
-class GCN(nn.Module):
-    def __init__(self):
-        super(GCN, self).__init__()
+# Local copy of the pretrained resnet50 weights, GCN never downloads them
+RESNET50_PATH = './data/gcn/resnet50.pth'
+
+
+def load_resnet50(path=RESNET50_PATH):
+    """Frozen pretrained resnet50 in eval mode, read from the local weights
+
+    Keyword Arguments:
+        path {str} -- Saved state dict of torchvision resnet50 (default: {RESNET50_PATH})
+    """
+    if not os.path.exists(path):
+        raise Exception(f'Pretrained resnet50 weights not found at {path}, '
+                        'run "python create_resnet_score.py --download_weights" once with network access')
+    resnet50 = models.resnet50()
+    resnet50.load_state_dict(torch.load(path, map_location='cpu'))
+    for p in resnet50.parameters():
+        p.requires_grad = False
+    resnet50.eval()
+    return resnet50
+
+
+class GCNConstants:
+    """Constant parts of GCN: frozen resnet50, initial normalized adjacency and word embeddings
+
+    They are read from disk once per process (see gcn_constants) and every GCN
+    refers to the same resnet50. Training shares them with the workers, which
+    attach to them with attach_gcn_constants instead of reading them again.
+    """
 
-        self.resnet50 = models.resnet50(pretrained=True)
-        for p in self.resnet50.parameters():
-            p.requires_grad = False
-        self.resnet50.eval()
+    def __init__(self, gcn_path='./data/gcn', h5_file_path='./data/FloorPlan1.h5',
+                 resnet50_path=RESNET50_PATH):
+        """GCNConstants constructor, fails before reading anything if a file is missing
+
+        Keyword Arguments:
+            gcn_path {str} -- Folder of adjmat.dat and objects.txt (default: {'./data/gcn'})
+            h5_file_path {str} -- Scene dataset with the word embeddings of the objects (default: {'./data/FloorPlan1.h5'})
+            resnet50_path {str} -- Saved state dict of the pretrained resnet50 (default: {RESNET50_PATH})
+        """
+        adjmat_path = os.path.join(gcn_path, 'adjmat.dat')
+        objects_path = os.path.join(gcn_path, 'objects.txt')
+        missing = [path for path in [adjmat_path, objects_path, h5_file_path]
+                   if not os.path.exists(path)]
+        if missing:
+            raise Exception('GCN data not found: ' + ', '.join(missing))
+        self.resnet50 = load_resnet50(resnet50_path)
 
         # Load adj matrix for GCN
-        A_raw = torch.load("./data/gcn/adjmat.dat")
-        A = normalize_adj(A_raw).tocsr().toarray()
-        self.A = torch.nn.Parameter(torch.Tensor(A))
+        A_raw = torch.load(adjmat_path)
+        self.A = torch.Tensor(normalize_adj(A_raw).tocsr().toarray())
 
-        objects = open("./data/gcn/objects.txt").readlines()
-        objects = [o.strip() for o in objects]
-        self.n = len(objects)
-        self.register_buffer('all_glove', torch.zeros(self.n, 300))
+        objects = open(objects_path).readlines()
+        self.objects = [o.strip() for o in objects]
+        self.all_glove = torch.zeros(len(self.objects), 300)
 
         # Every dataset contain the same word embedding use FloorPlan1
-        h5_file = h5py.File("./data/FloorPlan1.h5", 'r')
-        object_ids = json.loads(h5_file.attrs['object_ids'])
-        object_vector = h5_file['object_vector']
-
-        word_embedding = {k: object_vector[v] for k, v in object_ids.items()}
-        for i, o in enumerate(objects):
+        with h5py.File(h5_file_path, 'r') as h5_file:
+            object_ids = json.loads(h5_file.attrs['object_ids'])
+            object_vector = h5_file['object_vector']
+            word_embedding = {k: object_vector[v] for k, v in object_ids.items()}
+        for i, o in enumerate(self.objects):
             self.all_glove[i, :] = torch.from_numpy(word_embedding[o])
 
-        h5_file.close()
+    def share_memory(self):
+        self.resnet50.share_memory()
+        self.A.share_memory_()
+        self.all_glove.share_memory_()
+        return self
+
+
+_gcn_constants = None
+
+
+def gcn_constants():
+    """GCNConstants of the process, read from disk the first time"""
+    global _gcn_constants
+    if _gcn_constants is None:
+        _gcn_constants = GCNConstants()
+    return _gcn_constants
+
+
+def attach_gcn_constants(constants):
+    """Use constants (e.g. shared by the main process) as GCNConstants of the process"""
+    global _gcn_constants
+    _gcn_constants = constants
+
+
+class GCN(nn.Module):
+    def __init__(self):
+        super(GCN, self).__init__()
+
+        constants = gcn_constants()
+
+        # Frozen resnet50 shared by every GCN of the process, it stays in the
+        # state dict so that checkpoints keep the same keys
+        self.resnet50 = constants.resnet50
+
+        # Normalized adjacency, trained with the rest of the network. The
+        # graph convolutions use a sparse copy when no gradient is needed
+        self.A = torch.nn.Parameter(constants.A.clone())
+        self.sparse_adjacency = True
+        self._adjacency = None
+        self._adjacency_version = None
+
+        self.n = len(constants.objects)
+        self.register_buffer('all_glove', constants.all_glove.clone())
 
         nhid = 1024
         # Convert word embedding to input for gcn
@@ -645,25 +1253,48 @@ class GCN(nn.Module):
 
         self.mapping = nn.Linear(self.n, 512)
 
+        # Word embeddings are constant, word_to_gcn is applied once per weight update
+        self.word_cache = TargetCache(self.word_to_gcn, flatten=False, activation=None)
+
+    def adjacency(self):
+        """Sparse copy of A without autograd, built again when A is updated, loaded or moved
+
+        A itself is returned when its gradient is needed (training) or when
+        sparse_adjacency is False.
+        """
+        if not self.sparse_adjacency or (self.A.requires_grad and torch.is_grad_enabled()):
+            return self.A
+        version = (self.A.data_ptr(), self.A._version)
+        if version != self._adjacency_version:
+            self._adjacency = self.A.detach().to_sparse()
+            self._adjacency_version = version
+        return self._adjacency
+
     def gcn_embed(self, x):
 
-        resnet_score = self.resnet50(x)
+        # x is the observation [batch, 3, h, w] or its precomputed resnet50 scores [batch, 1000]
+        resnet_score = x if x.dim() == 2 else self.resnet50(x)
         resnet_embed = self.resnet_to_gcn(resnet_score)
-        word_embedding = self.word_to_gcn(self.all_glove)
+        word_embedding = self.word_cache(self.all_glove)
 
+        # [batch, n, 1024], one graph per observation
         output = torch.cat(
-            (resnet_embed.repeat(self.n, 1), word_embedding), dim=1)
+            (resnet_embed.unsqueeze(1).expand(-1, self.n, -1),
+             word_embedding.unsqueeze(0).expand(resnet_embed.size(0), -1, -1)), dim=2)
         return output
 
     def forward(self, x):
 
-        # x = (current_obs)
+        # x = (current_obs) [batch, 3, h, w] or (resnet_score) [batch, 1000]
         # Convert input to gcn input
         x = self.gcn_embed(x)
-
-        x = F.relu(self.gc1(x, self.A))
-        x = F.relu(self.gc2(x, self.A))
-        x = F.relu(self.gc3(x, self.A))
-        x = x.view(-1)
+        if x.size(0) == 1:
+            x = x[0]
+
+        A = self.adjacency()
+        x = F.relu(self.gc1(x, A))
+        x = F.relu(self.gc2(x, A))
+        x = F.relu(self.gc3(x, A))
+        x = x.reshape(-1, self.n)
         x = self.mapping(x)
         return x
@@ -0,0 +1,121 @@
+import json
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Feedforward methods and the inputs of their network, in order (see POLICY_INPUTS)
+NUMPY_POLICY_INPUTS = {
+    'word2vec': ['observation', 'word_target', 'similarity_grid'],
+    'word2vec_noconv': ['observation', 'word_target', 'similarity_grid'],
+    'word2vec_notarget': ['observation', 'similarity_grid'],
+    'word2vec_nosimi': ['observation', 'word_target'],
+    'aop': ['observation', 'word_target', 'bbox_grid'],
+    'aop_we': ['observation', 'word_target', 'bbox_grid'],
+    'target_driven': ['observation', 'resnet_target'],
+}
+
+
+def linear(weights, name, x):
+    # Low-rank layer (see LowRankLinear)
+    if name + '.down.weight' in weights:
+        x = np.dot(weights[name + '.down.weight'], x)
+        name = name + '.up'
+    return np.dot(weights[name + '.weight'], x) + weights[name + '.bias']
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def conv2d(weights, name, x):
+    """Valid convolution with stride 1 of x [in_channels, h, w]"""
+    weight = weights[name + '.weight']
+    (out_channels, in_channels, kh, kw) = weight.shape
+    (_, h, w) = x.shape
+    x = np.ascontiguousarray(x)
+    # [in_channels, h', w', kh, kw] windows of x without copy
+    windows = as_strided(x, shape=(in_channels, h - kh + 1, w - kw + 1, kh, kw),
+                         strides=x.strides + x.strides[1:])
+    out = np.tensordot(weight, windows, axes=([1, 2, 3], [0, 3, 4]))
+    return out + weights[name + '.bias'][:, np.newaxis, np.newaxis]
+
+
+def max_pool2d(x, kernel=2):
+    """Max pooling of x [channels, h, w] with stride kernel"""
+    (channels, h, w) = x.shape
+    (h, w) = (h // kernel, w // kernel)
+    x = x[:, :h * kernel, :w * kernel]
+    return x.reshape(channels, h, kernel, w, kernel).max(axis=(2, 4))
+
+
+def render_numpy_input(env, name):
+    """Array name of NUMPY_POLICY_INPUTS for the current state of env"""
+    if name == 'observation':
+        return env.render('resnet_features')
+    elif name == 'word_target':
+        return env.render_target('word_features')
+    elif name == 'resnet_target':
+        return env.render_target('resnet_features')
+    elif name == 'similarity_grid':
+        return env.render_mask_similarity()
+    elif name == 'bbox_grid':
+        return env.render_mask()
+    raise Exception('Unknown policy input ' + name)
+
+
+class NumpyPolicy:
+    """Feedforward policy exported by export_policy.py --numpy, run with NumPy only
+
+    Same computation as nn.Sequential(SharedNetwork, SceneSpecificNetwork)
+    for a single state in float32, torch is not imported.
+    """
+
+    def __init__(self, path):
+        """NumpyPolicy constructor
+
+        Arguments:
+            path {str} -- .npz file written by export_numpy_policy
+        """
+        with np.load(path) as data:
+            self.description = json.loads(str(data['__policy__']))
+            weights = {k: data[k] for k in data.files if k != '__policy__'}
+        self.method = self.description['method']
+        self.inputs = self.description['inputs']
+        # Layers of SharedNetwork and SceneSpecificNetwork
+        self.shared = {k[len('0.net.'):]: v for k, v in weights.items() if k.startswith('0.net.')}
+        self.scene = {k[len('1.'):]: v for k, v in weights.items() if k.startswith('1.')}
+
+    def __call__(self, env):
+        """(policy logits, value) for the current state of env"""
+        return self.forward(*[render_numpy_input(env, name) for name in self.inputs])
+
+    def forward(self, *inputs):
+        """(policy logits, value) for the inputs of NUMPY_POLICY_INPUTS[method]"""
+        inputs = [np.asarray(x, dtype=np.float32) for x in inputs]
+        x = self.forward_shared(*inputs)
+        x = relu(linear(self.scene, 'fc1', x))
+        return linear(self.scene, 'fc2_policy', x), linear(self.scene, 'fc2_value', x)[0]
+
+    def forward_shared(self, *inputs):
+        w = self.shared
+        x = inputs[0].reshape(-1)
+        if self.method == 'target_driven':
+            y = inputs[1].reshape(-1)
+            x = relu(linear(w, 'fc_siemense', x))
+            y = relu(linear(w, 'fc_siemense', y))
+            return relu(linear(w, 'fc_merge', np.concatenate([x, y])))
+
+        features = [relu(linear(w, 'fc_observation', x))]
+        if 'word_target' in self.inputs:
+            features.append(relu(linear(w, 'fc_target', inputs[1].reshape(-1))))
+
+        if self.method == 'word2vec' or self.method == 'word2vec_notarget':
+            z = inputs[-1].reshape((1,) + inputs[-1].shape[-2:])
+            z = max_pool2d(relu(conv2d(w, 'conv1', z)))
+            z = max_pool2d(relu(conv2d(w, 'conv2', z)))
+            features.append(z.reshape(-1))
+        elif self.method == 'word2vec_noconv':
+            features.append(relu(linear(w, 'fc_similarity', inputs[-1].reshape(-1))))
+        elif self.method == 'aop' or self.method == 'aop_we':
+            features.append(inputs[-1].reshape(-1))
+        return relu(linear(w, 'fc_merge', np.concatenate(features)))
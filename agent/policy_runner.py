@@ -0,0 +1,97 @@
+import json
+
+import torch
+
+from agent.utils import inference_mode
+
+# Name of the tensors given to the network of each method, in order
+POLICY_INPUTS = {
+    'word2vec': ['observation', 'word_target', 'similarity_grid'],
+    'word2vec_noconv': ['observation', 'word_target', 'similarity_grid'],
+    'word2vec_notarget': ['observation', 'similarity_grid'],
+    'word2vec_nosimi': ['observation', 'word_target'],
+    'word2vec_notarget_lstm': ['last_frame', 'similarity_grid', 'hidden', 'cell'],
+    'word2vec_notarget_lstm_2layer': ['last_frame', 'similarity_grid', 'hidden', 'cell'],
+    'word2vec_notarget_lstm_3layer': ['last_frame', 'similarity_grid', 'hidden', 'cell'],
+    'word2vec_notarget_rnn': ['last_frame', 'similarity_grid', 'hidden'],
+    'word2vec_notarget_gru': ['last_frame', 'similarity_grid', 'hidden'],
+    'aop': ['observation', 'word_target', 'bbox_grid'],
+    'aop_we': ['observation', 'word_target', 'bbox_grid'],
+    'target_driven': ['observation', 'resnet_target'],
+    'gcn': ['observation', 'word_target', 'resnet_score'],
+}
+
+
+def render_input(env, name, device):
+    """Tensor name of POLICY_INPUTS for the current state of env"""
+    if name == 'observation':
+        return env.render_tensor('resnet_features', device)
+    elif name == 'last_frame':
+        return env.render_last_frame(device)
+    elif name == 'word_target':
+        return env.render_target_tensor('word_features', device)
+    elif name == 'resnet_target':
+        return env.render_target_tensor('resnet_features', device)
+    elif name == 'similarity_grid':
+        return torch.from_numpy(env.render_mask_similarity()).to(device)
+    elif name == 'bbox_grid':
+        return torch.from_numpy(env.render_mask()).to(device)
+    elif name == 'resnet_score':
+        return env.render_resnet_score_tensor(device)
+    elif name == 'rgb':
+        from agent.method.gcn import normalize
+        return normalize(env.observation).unsqueeze(0).to(device)
+    elif name == 'hidden':
+        hidden = env.render_hidden_state()
+        return (hidden[0] if isinstance(hidden, tuple) else hidden).to(device)
+    elif name == 'cell':
+        return env.render_hidden_state()[1].to(device)
+    raise Exception('Unknown policy input ' + name)
+
+
+def load_policy(path, device=torch.device('cpu')):
+    """Policy exported by export_policy.py and its description
+
+    Returns:
+        tuple -- (torch.jit.ScriptModule, dict with method, inputs, action_size)
+    """
+    extra_files = {'policy.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    module.eval()
+    return module, json.loads(extra_files['policy.json'])
+
+
+class PolicyRunner:
+    """Serves a policy exported by export_policy.py
+
+    Only needs the environment and the TorchScript module, the networks and
+    methods used for training are not imported.
+    """
+
+    def __init__(self, path, device=torch.device('cpu')):
+        """PolicyRunner constructor
+
+        Arguments:
+            path {str} -- Exported policy
+
+        Keyword Arguments:
+            device {torch.device} -- Device of the policy (default: {torch.device('cpu')})
+        """
+        self.device = device
+        (self.module, self.description) = load_policy(path, device)
+        self.method = self.description['method']
+        self.inputs = self.description['inputs']
+        self.recurrent = 'hidden' in self.inputs
+
+    def __call__(self, env):
+        """(policy logits, value) for the current state of env
+
+        The hidden state of recurrent policies is read from and stored to env.
+        """
+        inputs = [render_input(env, name, self.device) for name in self.inputs]
+        with inference_mode():
+            outputs = self.module(*inputs)
+        if self.recurrent:
+            hidden = outputs[2:]
+            env.set_hidden(tuple(hidden) if len(hidden) > 1 else hidden[0])
+        return outputs[0], outputs[1]
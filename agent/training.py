@@ -12,8 +12,10 @@ import torch.nn as nn
 
 from agent.environment.ai2thor_file import \
     THORDiscreteEnvironment as THORDiscreteEnvironmentFile
+from agent.environment.scene_store import SceneStore
 from agent.gpu_thread import GPUThread
-from agent.network import SceneSpecificNetwork, SharedNetwork
+from agent.network import (MultiSceneNetwork, SharedNetwork, create_scene_network,
+                           gcn_constants)
 from agent.optim import SharedRMSprop
 from agent.summary_thread import SummaryThread
 from agent.training_thread import TrainingThread
@@ -53,6 +55,8 @@ class TrainingSaver:
         model = dict()
         model['navigation'] = self.shared_network.state_dict()
         model['navigation/scene'] = self.scene_network.state_dict()
+        if isinstance(self.scene_network, MultiSceneNetwork):
+            model['navigation/scenes'] = self.scene_network.scenes
         model['optimizer'] = self.optimizer.state_dict()
         model['config'] = conf
 
@@ -77,6 +81,11 @@ class TrainingSaver:
             new_state_dict['net.'+key] = value
         self.shared_network.load_state_dict(new_state_dict)
 
+        # Scenes of the per-scene heads (see MultiSceneNetwork)
+        if 'navigation/scenes' in state:
+            if not isinstance(self.scene_network, MultiSceneNetwork):
+                raise Exception('Checkpoint has one policy head per scene, set scene_heads')
+            self.scene_network.scenes = list(state['navigation/scenes'])
         self.scene_network.load_state_dict(
             state[f'navigation/scene'])
 
@@ -110,8 +119,10 @@ class TrainingOptimizer:
     def _ensure_shared_grads(self, model, shared_model, gpu=False):
         for param, shared_param in zip(filter(lambda p: p.requires_grad, model.parameters()),
                                        filter(lambda p: p.requires_grad, shared_model.parameters())):
-            if shared_param.grad is not None and not gpu:
-                return
+            # Parameters without gradient (heads of other scenes, see
+            # MultiSceneNetwork) are skipped by the optimizer
+            if param.grad is None:
+                shared_param._grad = None
             elif not gpu:
                 shared_param._grad = param.grad
             else:
@@ -127,7 +138,10 @@ class TrainingOptimizer:
         with self.lock:
             self.global_step.copy_(torch.tensor(self.global_step.item() + 1))
 
-        local.zero_grad()
+        # Gradients are removed rather than zeroed, parameters unused by the
+        # loss keep no gradient
+        for param in local.parameters():
+            param.grad = None
         self.optimizer.zero_grad()
 
         # Calculate the new gradient with the respect to the local network
@@ -216,8 +230,11 @@ class Training:
     def initialize(self):
         # Shared network
         self.shared_network = SharedNetwork(
-            self.method, self.config.get('mask_size', 5))
-        self.scene_network = SceneSpecificNetwork(self.config['action_size'])
+            self.method, self.config.get('mask_size', 5),
+            observation_rank=self.config.get('observation_rank'))
+        # One policy head per training scene with scene_heads
+        scenes = sorted(self.config['task_list']) if self.config.get('scene_heads', False) else None
+        self.scene_network = create_scene_network(self.config['action_size'], scenes)
 
         # Share memory
         self.shared_network = self.shared_network
@@ -260,6 +277,44 @@ class Training:
                 it = it + 1
                 branches.append((scene, target))
 
+        # Load every scene once, workers attach to the shared arrays
+        # Resnet features are not loaded when they are streamed from disk
+        streaming = self.config.get('streaming', False)
+        feature_dtype = self.config.get('feature_dtype', 'float32')
+        scene_store = SceneStore(self.config['h5_file_path'], resnet_feature=not streaming,
+                                 feature_dtype=feature_dtype)
+        for scene in self.tasks.keys():
+            scene_store.load(scene)
+
+        # Start states of every task are computed once and saved with the
+        # experiment, a saved pool must match the dataset of the new run
+        start_pool_path = None
+        if 'base_path' in self.config:
+            start_pool_path = os.path.join(
+                self.config['base_path'], 'start_pools.npz')
+        for (scene, target) in branches:
+            THORDiscreteEnvironmentFile(method=self.method,
+                                        reward=self.reward_fun,
+                                        scene_name=scene,
+                                        terminal_state=target,
+                                        h5_file_path=self.config['h5_file_path'].replace(
+                                            '{scene}', scene),
+                                        action_size=self.config['action_size'],
+                                        mask_size=self.config.get('mask_size', 5),
+                                        scene_store=scene_store,
+                                        streaming=streaming,
+                                        feature_dtype=feature_dtype).stop()
+        if start_pool_path is not None:
+            if os.path.exists(start_pool_path):
+                scene_store.check_start_pools(start_pool_path)
+            scene_store.save_start_pools(start_pool_path)
+        scene_store.share_memory()
+
+        # Frozen parts of gcn are read once, workers attach to them
+        shared_constants = None
+        if self.method == 'gcn':
+            shared_constants = gcn_constants().share_memory()
+
         def _createThread(id, tasks, summary_queue, device):
             network = nn.Sequential(self.shared_network, self.scene_network)
             network.share_memory()
@@ -274,6 +329,8 @@ class Training:
                 method=self.method,
                 reward=self.reward_fun,
                 tasks=tasks,
+                scene_store=scene_store,
+                gcn_constants=shared_constants,
                 kwargs=self.config)
 
         # # Retrieve number of task
@@ -13,13 +13,15 @@ import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 
-from agent.environment.ai2thor_file import \
-    THORDiscreteEnvironment as THORDiscreteEnvironmentFile
+from agent.environment.ai2thor_file import THORSceneCache
 from agent.method.aop import AOP
 from agent.method.gcn import GCN
 from agent.method.similarity_grid import SimilarityGrid
 from agent.method.target_driven import TargetDriven
-from agent.network import ActorCriticLoss, SceneSpecificNetwork, SharedNetwork
+from agent.network import (ActorCriticLoss, SceneSpecificNetwork, SharedNetwork,
+                           attach_gcn_constants, clear_target_caches,
+                           create_scene_network, select_scene)
+from agent.utils import inference_mode
 from torchvision import transforms
 
 
@@ -60,7 +62,9 @@ class TrainingThread(mp.Process):
                  method: str,
                  reward: str,
                  tasks: list,
-                 kwargs):
+                 kwargs,
+                 scene_store=None,
+                 gcn_constants=None):
         """TrainingThread constructor
 
         Arguments:
@@ -70,6 +74,8 @@ class TrainingThread(mp.Process):
             optimizer {[type]} -- Optimizer to use
             scene {str} -- Name of the current world
             summary_queue {mp.Queue} -- Queue to pass scalar to tensorboard logger
+            scene_store {SceneStore} -- Scene arrays shared by all TrainingThread (default: {None})
+            gcn_constants {GCNConstants} -- Frozen parts of gcn shared by all TrainingThread (default: {None})
         """
 
         super(TrainingThread, self).__init__()
@@ -92,6 +98,8 @@ class TrainingThread(mp.Process):
         self.reward = reward
         self.tasks = tasks
         self.scenes = set([scene for (scene, target) in tasks])
+        self.scene_store = scene_store
+        self.gcn_constants = gcn_constants
 
     def _sync_network(self, scene):
         if self.init_args['cuda']:
@@ -101,6 +109,9 @@ class TrainingThread(mp.Process):
         else:
             state_dict = self.master_network.state_dict()
             self.policy_networks.load_state_dict(state_dict)
+        select_scene(self.policy_networks, scene)
+        # Target projections are computed once per rollout, with a new graph
+        clear_target_caches(self.policy_networks)
 
     def get_action_space_size(self):
         return len(self.envs[0].actions)
@@ -119,15 +130,19 @@ class TrainingThread(mp.Process):
 
         self.mask_size = self.init_args.get('mask_size', 5)
 
+        # Mask actions colliding with a wall before sampling
+        self.action_mask = self.init_args.get('action_mask', False)
+
         args = self.init_args
         args.pop("reward")
         args.pop("method")
-        self.envs = [THORDiscreteEnvironmentFile(method=self.method,
-                                                 reward=self.reward,
-                                                 scene_name=scene,
-                                                 terminal_state=task,
-                                                 **args)
-                     for (scene, task) in self.tasks]
+        # Environments are created when their task is first selected
+        self.envs = THORSceneCache(self.tasks,
+                                   max_open_scenes=args.pop('max_open_scenes', 8),
+                                   scene_store=self.scene_store,
+                                   method=self.method,
+                                   reward=self.reward,
+                                   **args)
 
         self.gamma: float = self.init_args.get('gamma', 0.99)
         self.grad_norm: float = self.init_args.get('grad_norm', 40.0)
@@ -138,13 +153,21 @@ class TrainingThread(mp.Process):
 
         self.criterion = ActorCriticLoss(entropy_beta)
 
+        # The local network refers to the shared resnet50 instead of reading its own
+        if self.gcn_constants is not None:
+            attach_gcn_constants(self.gcn_constants)
+
         self.policy_networks = nn.Sequential(SharedNetwork(
-            self.method, self.mask_size), SceneSpecificNetwork(self.get_action_space_size())).to(self.device)
+            self.method, self.mask_size, observation_rank=self.init_args.get('observation_rank')),
+            create_scene_network(self.get_action_space_size(),
+                                 getattr(self.master_network[1], 'scenes', None))).to(self.device)
+        # Recurrent networks are trained on whole rollouts, see _forward_sequence
+        self.recurrent = self.policy_networks[0].recurrent
         # Store action for each episode
         self.saved_actions = []
-        # Initialize the episode
-        for idx, _ in enumerate(self.envs):
-            self._reset_episode(idx)
+        self.episode_reward = 0
+        self.episode_length = 0
+        self.episode_max_q = torch.FloatTensor([-np.inf]).to(self.device)
         for scene in self.scenes:
             self._sync_network(scene)
 
@@ -175,13 +198,26 @@ class TrainingThread(mp.Process):
         terminal_end = False
 
         results = {"policy": [], "value": []}
-        rollout_path = {"state": [], "action": [], "rewards": [], "done": []}
+        rollout_path = {"state": [], "action": [], "rewards": [], "done": [],
+                        "valid_actions": []}
 
         # Plays out one game to end or max_t
         for t in range(self.max_t):
 
-            policy, value, state = self.method_class.forward_policy(
-                self.envs[idx], self.device, self.policy_networks)
+            if self.recurrent:
+                # The graph is built when the rollout is run again as one sequence
+                with torch.no_grad():
+                    policy, value, state = self.method_class.forward_policy(
+                        self.envs[idx], self.device, self.policy_networks)
+            else:
+                policy, value, state = self.method_class.forward_policy(
+                    self.envs[idx], self.device, self.policy_networks)
+
+            if self.action_mask:
+                valid_actions = self.envs[idx].valid_actions()
+                rollout_path["valid_actions"].append(valid_actions)
+                policy = SceneSpecificNetwork.mask_policy(
+                    policy, torch.from_numpy(valid_actions).to(self.device))
 
             if (self.id == 0) and (self.local_t % 100) == 0:
                 print(f'Local Step {self.local_t}')
@@ -190,7 +226,7 @@ class TrainingThread(mp.Process):
             results["policy"].append(policy)
             results["value"].append(value)
 
-            with torch.no_grad():
+            with inference_mode():
                 (_, action,) = policy.max(0)
                 action = F.softmax(policy, dim=0).multinomial(1).item()
 
@@ -276,11 +312,50 @@ class TrainingThread(mp.Process):
         if terminal_end:
             return 0.0, results, rollout_path, terminal_end
         else:
-            policy, value, state = self.method_class.forward_policy(
-                self.envs[idx], self.device, self.policy_networks)
+            # Bootstrap value, no gradient needed
+            with inference_mode():
+                policy, value, state = self.method_class.forward_policy(
+                    self.envs[idx], self.device, self.policy_networks)
             return value.data.item(), results, rollout_path, terminal_end
 
+    def _forward_sequence(self, rollout_path):
+        """Policy and value of every step of a rollout with a recurrent network
+
+        The rollout is run again from the hidden state of its first step as a
+        single [T, ...] sequence: one call of the recurrent layer, and the
+        gradients flow through the hidden states of the rollout (truncated
+        backpropagation through time over at most max_t steps).
+
+        Arguments:
+            rollout_path {dict} -- Rollout of _forward_explore
+
+        Returns:
+            dict -- policy and value of each step, as returned by _forward_explore
+        """
+        states = rollout_path["state"]
+        x = torch.from_numpy(np.stack([state["current"] for state in states])).to(self.device)
+        object_mask = torch.from_numpy(
+            np.stack([state["object_mask"] for state in states])).to(self.device)
+        # The hidden state may have been set in inference mode (bootstrap
+        # value), a copy can be saved for backward
+        hidden = states[0]["hidden"]
+        if isinstance(hidden, tuple):
+            hidden = tuple(h.to(self.device).clone() for h in hidden)
+        else:
+            hidden = hidden.to(self.device).clone()
+
+        (x, _) = self.policy_networks[0]((x, object_mask, hidden))
+        (policy, value) = self.policy_networks[1](x)
+        if self.action_mask:
+            valid_actions = torch.from_numpy(np.stack(rollout_path["valid_actions"]))
+            policy = SceneSpecificNetwork.mask_policy(
+                policy, valid_actions.to(self.device))
+        return {"policy": list(policy), "value": list(value)}
+
     def _optimize_path(self, scene, playout_reward: float, results, rollout_path):
+        if self.recurrent:
+            results = self._forward_sequence(rollout_path)
+
         policy_batch = []
         value_batch = []
         action_batch = []
@@ -340,12 +415,20 @@ class TrainingThread(mp.Process):
             random.shuffle(idx)
             j = 0
 
-            # reset all env
-            self.envs = [env for env in self.envs if env.reset()]
             while not self.exit.is_set() and self.optimizer.get_global_step() * self.max_t < self.init_args["total_step"]:
                 # Load current task with scene
                 (scene, target) = self.tasks[idx[j]]
 
+                # Drop target without accessible start state, environments are
+                # created on first use so it is only known once selected
+                if len(self.envs[idx[j]].start_pool) == 0:
+                    print(f'Thread {self.id}: no start state for {scene} {target}, task dropped')
+                    del idx[j]
+                    if len(idx) == 0:
+                        raise Exception(f'Thread {self.id}: no task has an accessible start state')
+                    j = j % len(idx)
+                    continue
+
                 # Change episode if it's a terminal episode (goal reached or max step)
                 terminal = False
                 while not terminal and not self.exit.is_set() and self.optimizer.get_global_step() * self.max_t < self.init_args["total_step"]:
@@ -368,10 +451,10 @@ class TrainingThread(mp.Process):
 
                 # New episode with different scene/task
                 j = j + 1
-                j = j % len(self.tasks)
+                j = j % len(idx)
                 # pass
             self.stop()
-            [env.stop() for env in self.envs]
+            self.envs.stop()
         except Exception as e:
             # self.logger.error(e.msg)
             raise e
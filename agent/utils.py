@@ -64,6 +64,14 @@ def find_restore_points(checkpoint_path, fail=True):
         return (checkpoint_path, None)
 
 
+def inference_mode():
+    """torch.inference_mode when available (torch >= 1.9), torch.no_grad otherwise"""
+    import torch
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
 def populate_config(config, mode='train', checkpoint=True):
     exp_path = config['exp']
     json_file = open(exp_path)
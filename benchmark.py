@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import argparse
+
+import h5py
+import numpy as np
+
+from agent.benchmark import compare_policies, load_network, print_comparison
+from agent.environment.scene_store import dequantize_features, quantize_features
+from agent.network import quantize_network
+from agent.utils import populate_config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare reduced precision features or an int8 quantized network to float32.')
+    parser.add_argument('--h5_file_path', type=str,
+                        default='/app/data/{scene}_keras.h5')
+    parser.add_argument('--checkpoint_path', type=str, default=None)
+    parser.add_argument('--feature_dtype', type=str, default=None,
+                        choices=['float32', 'float16', 'int8'],
+                        help='Features of the candidate (default: float16, float32 with --quantize)')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Candidate uses int8 dynamic quantization of the linear layers')
+    parser.add_argument('--num_episode', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+
+    # Use experiment.json
+    parser.add_argument('--exp', '-e', type=str,
+                        help='Experiment parameters.json file', required=True)
+
+    args = vars(parser.parse_args())
+    args = populate_config(args, mode='eval',
+                           checkpoint=args['checkpoint_path'] is None)
+    if args['feature_dtype'] is None:
+        args['feature_dtype'] = 'float32' if args['quantize'] else 'float16'
+
+    # Reconstruction error of the features
+    if args['feature_dtype'] != 'float32':
+        for scene_scope in args['task_list']:
+            with h5py.File(args['h5_file_path'].replace('{scene}', scene_scope), 'r') as h5_file:
+                features = h5_file['resnet_feature'][()]
+            arrays = quantize_features(features, args['feature_dtype'])
+            restored = dequantize_features(arrays['resnet_feature'],
+                                           arrays.get('resnet_feature_scale'),
+                                           arrays.get('resnet_feature_offset'))
+            error = np.abs(restored - features)
+            print('%s: %.1f MB -> %.1f MB | max error %.5f | relative error %.5f' % (
+                scene_scope, features.nbytes / 2**20, arrays['resnet_feature'].nbytes / 2**20,
+                error.max(), error.sum() / np.abs(features).sum()))
+
+    network = load_network(args)
+    candidate = quantize_network(network) if args['quantize'] else network
+    name = args['feature_dtype'] + (' quantized' if args['quantize'] else '')
+    results = compare_policies(args, (network, dict(feature_dtype='float32')),
+                               (candidate, dict(feature_dtype=args['feature_dtype'])),
+                               num_episode=args['num_episode'], seed=args['seed'])
+    print_comparison(results, name)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import argparse
+import copy
+import os
+from contextlib import suppress
+
+import torch
+import torch.nn as nn
+
+from agent.benchmark import compare_policies, load_network, print_comparison
+from agent.network import (MultiSceneNetwork, SharedNetwork,
+                           factorize_observation_layer)
+from agent.utils import find_restore_point, populate_config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compress the observation layer of a checkpoint with a truncated SVD.')
+    parser.add_argument('--h5_file_path', type=str,
+                        default='/app/data/{scene}_keras.h5')
+    parser.add_argument('--checkpoint_path', type=str, default=None)
+    parser.add_argument('--rank', '-r', type=int, required=True)
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Compressed checkpoint (default: checkpoints_rank{rank} in the experiment folder)')
+    parser.add_argument('--num_episode', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+
+    # Use experiment.json
+    parser.add_argument('--exp', '-e', type=str,
+                        help='Experiment parameters.json file', required=True)
+
+    args = vars(parser.parse_args())
+    args = populate_config(args, mode='eval',
+                           checkpoint=args['checkpoint_path'] is None)
+    rank = args['rank']
+    if args['output'] is None:
+        (base_name, _) = find_restore_point(args['checkpoint_path'])
+        args['output'] = os.path.join(args['base_path'], 'checkpoints_rank%d' % rank,
+                                      os.path.basename(base_name))
+
+    network = load_network(args)
+    compressed = nn.Sequential(
+        SharedNetwork(args['method'], args.get('mask_size', 5), observation_rank=rank),
+        copy.deepcopy(network[1]))
+    compressed[0].load_state_dict(factorize_observation_layer(
+        network[0].state_dict(), args['method'], rank))
+    compressed.eval()
+
+    # Size and approximation error of the observation layer, the checkpoint may already be low-rank
+    dense = network[0].net.fc_siemense if args['method'] == 'target_driven' else network[0].net.fc_observation
+    low_rank = compressed[0].net.fc_siemense if args['method'] == 'target_driven' else compressed[0].net.fc_observation
+    with torch.no_grad():
+        error = torch.norm(low_rank.weight - dense.weight) / torch.norm(dense.weight)
+    print('observation layer: %d -> %d parameters | relative error %.5f' % (
+        sum(p.numel() for p in dense.parameters()) - dense.bias.numel(),
+        sum(p.numel() for p in low_rank.parameters()) - low_rank.bias.numel(),
+        error.item()))
+
+    results = compare_policies(args, (network, dict()), (compressed, dict()),
+                               num_episode=args['num_episode'], seed=args['seed'])
+    print_comparison(results, 'rank %d' % rank)
+    print('success %+.2f%% | spl %+.3f | speedup %.2fx' % (
+        results['candidate']['success'] - results['reference']['success'],
+        results['candidate']['spl'] - results['reference']['spl'],
+        results['reference']['latency'] / results['candidate']['latency']))
+
+    with suppress(FileExistsError):
+        os.makedirs(os.path.dirname(args['output']))
+    state = {'navigation': compressed[0].state_dict(),
+             'navigation/scene': compressed[1].state_dict(),
+             'config': {'method': args['method'],
+                        'action_size': args['action_size'],
+                        'mask_size': args.get('mask_size', 5),
+                        'observation_rank': rank}}
+    if isinstance(compressed[1], MultiSceneNetwork):
+        state['navigation/scenes'] = compressed[1].scenes
+    torch.save(state, open(args['output'], 'wb'))
+    print('Saved', args['output'])
@@ -22,6 +22,8 @@ from pytorchyolo3.darknet import Darknet
 from pytorchyolo3.models.tiny_yolo import TinyYoloNet
 from pytorchyolo3.utils import *
 
+from agent.environment.pose_index import PoseIndex, pose_key
+
 scene_type = []
 SCENES = [0, 200, 300, 400]
 TRAIN_SPLIT = (1, 22)
@@ -227,18 +229,8 @@ OBJECT_IDS = {
 }
 
 
-def equal(s1, s2):
-    if s1.pos["x"] == s2.pos["x"] and s1.pos["z"] == s2.pos["z"]:
-        if s1.rot == s2.rot:
-            return True
-    return False
-
-
-def search_namedtuple(list_states, search_state):
-    for s in list_states:
-        if equal(s, search_state):
-            return s
-    return None
+def state_key(s):
+    return pose_key(s.pos, s.rot)
 
 
 class NumpyEncoder(json.JSONEncoder):
@@ -298,6 +290,7 @@ def create_states(h5_file, resnet_trained, resnet_places, controller, name, args
         action='GetReachablePositions', gridSize=grid_size)).metadata['reachablePositions']
 
     states = []
+    state_index = PoseIndex()
     obss = []
     idx = 0
     # Does not redo if already existing
@@ -361,10 +354,11 @@ def create_states(h5_file, resnet_trained, resnet_places, controller, name, args
                             state.instance_detections2D, cls=NumpyEncoder),
                         obj_visible=json.dumps(obj_visible))
 
-                    if search_namedtuple(states, state_struct):
+                    if state_key(state_struct) in state_index:
                         print("Already exists")
                         # exit()
                     else:
+                        state_index.add(state_key(state_struct), idx)
                         states.append(state_struct)
                         idx = idx + 1
 
@@ -443,6 +437,7 @@ def create_states(h5_file, resnet_trained, resnet_places, controller, name, args
 def create_graph(h5_file, states, controller, args):
     num_states = len(states)
     graph = np.full((num_states, ACTION_SIZE), -1)
+    state_index = PoseIndex([state_key(s) for s in states])
     # Speed improvement
     state = controller.step(
         dict(action='Initialize', gridSize=grid_size, renderObjectImage=False))
@@ -465,15 +460,15 @@ def create_graph(h5_file, states, controller, args):
                                                      bbox=None,
                                                      obj_visible=None)
 
-                if not equal(state, state_controller_named) and not round(state_controller.metadata['agent']['cameraHorizon']) == 60:
-                    found = search_namedtuple(
-                        states, state_controller_named)
+                if state_key(state) != state_key(state_controller_named) and not round(state_controller.metadata['agent']['cameraHorizon']) == 60:
+                    found = state_index.poses.get(
+                        state_key(state_controller_named))
                     if found is None:
                         # print([(s.pos, s.rot) for s in states])
                         # print(state_controller_named)
                         print("Error, state not found")
                         continue
-                    graph[state.id][i] = found.id
+                    graph[state.id][i] = states[found].id
         if 'graph' in h5_file.keys():
             del h5_file['graph']
 
@@ -101,6 +101,8 @@ if __name__ == '__main__':
                         help='Method to use Ex : soft_goal')
 
     parser.add_argument('--eval_objects', action="store_true")
+    parser.add_argument('--action_mask', action="store_true",
+                        help='Mask actions colliding with a wall before sampling')
 
     args = vars(parser.parse_args())
     str_range = list(args["train_range"])
@@ -184,6 +186,7 @@ if __name__ == '__main__':
     train_param["seed"] = 1993
     train_param["reward"] = args["reward"]
     train_param["mask_size"] = 16
+    train_param["action_mask"] = args["action_mask"]
 
     data["train_param"] = train_param
     data["eval_param"] = {}
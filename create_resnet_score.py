@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import re
+
+import h5py
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import torchvision.models as models
+from agent.method.gcn import normalize
+from agent.network import RESNET50_PATH, load_resnet50
+
+
+def resnet_scores(observations, resnet50, device, batch_size=64):
+    """1000-d scores of the frozen ResNet-50 for every observation
+
+    Arguments:
+        observations {h5py.Dataset} -- [n_states, h, w, 3] RGB observations
+        resnet50 {nn.Module} -- Pretrained ResNet-50 in eval mode
+        device {torch.device} -- Device of resnet50
+
+    Keyword Arguments:
+        batch_size {int} -- Number of observation per forward (default: {64})
+
+    Returns:
+        np.ndarray -- [n_states, 1000] float32 scores
+    """
+    scores = np.zeros((observations.shape[0], 1000), dtype=np.float32)
+    with torch.no_grad():
+        for start in tqdm(range(0, observations.shape[0], batch_size)):
+            batch = torch.stack([normalize(obs) for obs in
+                                 observations[start:start + batch_size]])
+            scores[start:start + batch_size] = resnet50(batch.to(device)).cpu().numpy()
+    return scores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Store the ResNet-50 scores used by the gcn method.')
+    parser.add_argument('--h5_file_path', type=str, default='data/{scene}.h5')
+    parser.add_argument('--scene', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--resnet50_path', type=str, default=RESNET50_PATH)
+    parser.add_argument('--download_weights', action='store_true',
+                        help='Download the pretrained resnet50 weights to resnet50_path')
+    args = parser.parse_args()
+
+    # GCN only reads the local copy of the weights
+    if args.download_weights:
+        torch.save(models.resnet50(pretrained=True).state_dict(), args.resnet50_path)
+
+    if args.scene is not None:
+        h5_file_paths = [args.h5_file_path.replace('{scene}', args.scene)]
+    else:
+        h5_file_paths = sorted(glob.glob(args.h5_file_path.replace('{scene}', '*')))
+        # Only scene datasets (FloorPlan1.h5 but not FloorPlan1_keras.h5 for {scene}.h5)
+        pattern = re.escape(args.h5_file_path).replace(
+            re.escape('{scene}'), r'FloorPlan\d+') + '$'
+        h5_file_paths = [path for path in h5_file_paths if re.match(pattern, path)]
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    resnet50 = load_resnet50(args.resnet50_path).to(device)
+
+    for h5_file_path in h5_file_paths:
+        with h5py.File(h5_file_path, 'a') as h5_file:
+            if 'resnet_score' in h5_file:
+                if not args.force:
+                    print('Skipping', h5_file_path, '(resnet_score exists, use --force)')
+                    continue
+                del h5_file['resnet_score']
+            print('Processing', h5_file_path)
+            h5_file.create_dataset(
+                'resnet_score',
+                data=resnet_scores(h5_file['observation'], resnet50, device, args.batch_size))
@@ -17,6 +17,8 @@ if __name__ == '__main__':
     parser.add_argument('--checkpoint_path', type=str, default=None)
     parser.add_argument('--show', action='store_true')
     parser.add_argument('--train', action='store_true')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Int8 dynamic quantization of the linear layers (CPU)')
 
     # Use experiment.json
     parser.add_argument('--exp', '-e', type=str,
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import argparse
+import os
+
+from agent.benchmark import create_env, load_network
+from agent.export import export_numpy_policy, export_policy
+from agent.utils import populate_config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the policy of a checkpoint with TorchScript.')
+    parser.add_argument('--h5_file_path', type=str,
+                        default='/app/data/{scene}_keras.h5')
+    parser.add_argument('--checkpoint_path', type=str, default=None,
+                        help='Checkpoint file (default: latest checkpoint of the experiment)')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Exported policy (default: policy.pt or policy.npz in the experiment folder)')
+    parser.add_argument('--numpy', action='store_true',
+                        help='Export the weights of a feedforward policy for NumpyPolicy')
+
+    # Use experiment.json
+    parser.add_argument('--exp', '-e', type=str,
+                        help='Experiment parameters.json file', required=True)
+
+    args = vars(parser.parse_args())
+    args = populate_config(args, mode='eval',
+                           checkpoint=args['checkpoint_path'] is None)
+    if args['output'] is None:
+        args['output'] = os.path.join(
+            args['base_path'], 'policy.npz' if args['numpy'] else 'policy.pt')
+
+    network = load_network(args)
+    if args['numpy']:
+        description = export_numpy_policy(network, args['method'], args['output'],
+                                          args['action_size'])
+    else:
+        # Example inputs from the first task
+        scene_scope, items = next(iter(args['task_list'].items()))
+        env = create_env(args, scene_scope, items[0])
+        env.reset()
+        description = export_policy(network, args['method'], env, args['output'],
+                                    args['action_size'])
+        env.stop()
+    print('Exported', args['output'], description)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+import argparse
+import random
+import time
+
+import numpy as np
+
+from agent.environment.ai2thor_file import THORDiscreteEnvironment
+from agent.utils import populate_config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Evaluate a policy exported by export_policy.py.')
+    parser.add_argument('--h5_file_path', type=str,
+                        default='/app/data/{scene}_keras.h5')
+    parser.add_argument('--policy', '-p', type=str, required=True,
+                        help='TorchScript policy or .npz numpy policy (runs without torch)')
+    parser.add_argument('--num_episode', type=int, default=None)
+    parser.add_argument('--max_step', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=200)
+    parser.add_argument('--cuda', action='store_true')
+
+    # Use experiment.json
+    parser.add_argument('--exp', '-e', type=str,
+                        help='Experiment parameters.json file', required=True)
+
+    args = vars(parser.parse_args())
+    num_episode = args['num_episode']
+    args = populate_config(args, mode='eval', checkpoint=False)
+    num_episode = num_episode or args['num_episode']
+
+    start_time = time.perf_counter()
+    if args['policy'].endswith('.npz'):
+        from agent.numpy_policy import NumpyPolicy
+        runner = NumpyPolicy(args['policy'])
+        run_policy = runner
+    else:
+        import torch
+        from agent.policy_runner import PolicyRunner
+        runner = PolicyRunner(args['policy'], torch.device('cuda' if args['cuda'] else 'cpu'))
+
+        def run_policy(env):
+            policy, value = runner(env)
+            return policy.cpu().numpy(), value.item()
+    print('Loaded %s policy in %.2fs' % (runner.method, time.perf_counter() - start_time))
+
+    random.seed(args['seed'])
+    generator = np.random.RandomState(args['seed'])
+    success, spl, latency = [], [], []
+    for scene_scope, items in args['task_list'].items():
+        for task_scope in items:
+            env = THORDiscreteEnvironment(scene_name=scene_scope,
+                                          method=runner.method,
+                                          reward=args['reward'],
+                                          h5_file_path=args['h5_file_path'].replace(
+                                              '{scene}', scene_scope),
+                                          terminal_state=task_scope,
+                                          action_size=args['action_size'],
+                                          mask_size=args.get('mask_size', 5))
+            task_success = []
+            for episode in range(num_episode):
+                if not env.reset():
+                    continue
+                start = env.current_state_id
+                for t in range(args['max_step']):
+                    step_time = time.perf_counter()
+                    policy, _ = run_policy(env)
+                    policy = policy.astype(np.float64)
+                    if args.get('action_mask', False):
+                        policy[env.valid_actions() == 0] = -1e9
+                    policy = np.exp(policy - policy.max())
+                    action = generator.choice(len(policy), p=policy / policy.sum())
+                    latency.append(time.perf_counter() - step_time)
+                    env.step(action)
+                    env.reward
+                    if env.terminal:
+                        break
+                task_success.append(env.success)
+                spl.append(env.success * env.shortest_path_terminal(start) / (t + 1))
+            env.stop()
+            success.extend(task_success)
+            print('%s %s: %.2f%% success' % (
+                scene_scope, task_scope['object'], 100.0 * np.mean(task_success)))
+
+    print('%.2f%% success | %.3f spl | %.3f ms/step' % (
+        100.0 * np.mean(success), np.mean(spl), 1000.0 * np.mean(latency)))
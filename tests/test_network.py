@@ -0,0 +1,204 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from agent.network import (ObservationCache, SceneSpecificNetwork, SharedNetwork,
+                           clear_target_caches, factorize_observation_layer)
+
+MASK_SIZE = 16
+BATCH = 5
+
+FEEDFORWARD_METHODS = ['word2vec', 'word2vec_noconv', 'word2vec_notarget',
+                       'word2vec_nosimi', 'aop', 'aop_we', 'target_driven']
+RECURRENT_METHODS = ['word2vec_notarget_lstm', 'word2vec_notarget_lstm_2layer',
+                     'word2vec_notarget_lstm_3layer', 'word2vec_notarget_rnn',
+                     'word2vec_notarget_gru']
+
+
+def sample_inputs(method, n):
+    """n samples of the inputs of method, shaped as the environment renders them"""
+    observation = torch.rand(n, 2048, 4)
+    word = torch.rand(n, 300)
+    similarity = torch.rand(n, 1, 1, MASK_SIZE, MASK_SIZE)
+    resnet_target = torch.rand(n, 2048, 4)
+    bbox = torch.rand(n, MASK_SIZE, MASK_SIZE)
+    if method in ('word2vec', 'word2vec_noconv'):
+        return (observation, word, similarity)
+    elif method == 'word2vec_notarget':
+        return (observation, similarity)
+    elif method == 'word2vec_nosimi':
+        return (observation, word)
+    elif method == 'aop':
+        return (observation, resnet_target[:, :, 0], bbox)
+    elif method == 'aop_we':
+        return (observation, word, bbox)
+    elif method == 'target_driven':
+        return (observation, resnet_target)
+    raise Exception('No inputs for ' + method)
+
+
+def create_network(method):
+    torch.manual_seed(0)
+    network = nn.Sequential(SharedNetwork(method, MASK_SIZE), SceneSpecificNetwork(9))
+    # Targets are projected without the cache for a batch
+    for module in network.modules():
+        if hasattr(module, 'target_cache'):
+            module.target_cache = None
+    return network
+
+
+@pytest.mark.parametrize('method', FEEDFORWARD_METHODS)
+def test_batch_matches_samples(method):
+    network = create_network(method)
+    inputs = sample_inputs(method, BATCH)
+
+    (policy, value) = network(inputs)
+    assert policy.shape == (BATCH, 9)
+    assert value.shape == (BATCH,)
+    for i in range(BATCH):
+        (sample_policy, sample_value) = network(tuple(x[i] for x in inputs))
+        assert sample_policy.shape == (9,)
+        assert sample_value.shape == ()
+        assert torch.allclose(policy[i], sample_policy, atol=1e-5)
+        assert torch.allclose(value[i], sample_value, atol=1e-5)
+
+
+@pytest.mark.parametrize('method', ['word2vec', 'word2vec_notarget'])
+def test_batch_with_gradient_capture(method):
+    network = create_network(method)
+    network[0].enable_gradient_capture()
+    inputs = sample_inputs(method, BATCH)
+
+    (policy, value) = network(inputs)
+    (policy.sum() + value.sum()).backward()
+    assert network[0].net.gradient.size(0) == BATCH
+
+
+@pytest.mark.parametrize('method', RECURRENT_METHODS)
+def test_recurrent_batch_matches_samples(method):
+    network = create_network(method)
+    frames = torch.rand(BATCH, 2048)
+    similarity = torch.rand(BATCH, 1, 1, MASK_SIZE, MASK_SIZE)
+    lstm = network[0].net.lstm
+    hidden = torch.rand(lstm.num_layers, BATCH, 512)
+    if isinstance(lstm, nn.LSTM):
+        hidden = (hidden, torch.rand(lstm.num_layers, BATCH, 512))
+
+    # One step of BATCH sequences
+    (x, new_hidden) = network[0]((frames[None], similarity[None], hidden))
+    (policy, value) = network[1](x[0])
+    for i in range(BATCH):
+        if isinstance(hidden, tuple):
+            sample_hidden = tuple(h[:, i:i + 1].contiguous() for h in hidden)
+        else:
+            sample_hidden = hidden[:, i:i + 1].contiguous()
+        (x_i, _) = network[0]((frames[i], similarity[i], sample_hidden))
+        (sample_policy, sample_value) = network[1](x_i)
+        assert torch.allclose(policy[i], sample_policy, atol=1e-5)
+        assert torch.allclose(value[i], sample_value, atol=1e-5)
+
+
+def rollout_loss(network, method, target, steps=5):
+    """Loss of a rollout of steps observations with the same target"""
+    loss = 0
+    for inputs in zip(*sample_inputs(method, steps)):
+        inputs = inputs[:1] + (target,) + inputs[2:]
+        (policy, value) = network(inputs)
+        loss = loss + policy.sum() + value
+    return loss
+
+
+@pytest.mark.parametrize('method', ['word2vec', 'target_driven'])
+def test_target_cache_once_per_rollout(method):
+    torch.manual_seed(0)
+    network = nn.Sequential(SharedNetwork(method, MASK_SIZE), SceneSpecificNetwork(9))
+    uncached = create_network(method)
+    uncached.load_state_dict(network.state_dict())
+    target = sample_inputs(method, 1)[1][0]
+    calls = []
+
+    # target_driven applies the same layer to the observations
+    def count(module, x, y):
+        if torch.equal(x[0].reshape(-1), target.reshape(-1)):
+            calls.append(1)
+    network[0].net.target_cache.layer.register_forward_hook(count)
+
+    # Two rollouts with no weight update in between
+    for _ in range(2):
+        clear_target_caches(network)
+        network.zero_grad()
+        uncached.zero_grad()
+        calls.clear()
+        torch.manual_seed(1)
+        rollout_loss(network, method, target).backward()
+        torch.manual_seed(1)
+        rollout_loss(uncached, method, target).backward()
+        assert len(calls) == 1
+        for (p, q) in zip(network.parameters(), uncached.parameters()):
+            assert torch.allclose(p.grad, q.grad, atol=1e-5)
+
+
+def test_target_cache_reused_without_autograd():
+    torch.manual_seed(0)
+    network = nn.Sequential(SharedNetwork('word2vec', MASK_SIZE), SceneSpecificNetwork(9))
+    network.eval()
+    cache = network[0].net.target_cache
+    target = torch.rand(300)
+    with torch.no_grad():
+        output = cache(target)
+        assert cache(target) is output
+        # Updated weights invalidate the cache
+        network[0].net.fc_target.weight.add_(1.0)
+        assert not torch.equal(cache(target), output)
+
+
+def test_observation_cache_computes_new_blocks_only():
+    torch.manual_seed(0)
+    layer = nn.Linear(2048 * 4, 512)
+    cache = ObservationCache(layer)
+    computed = []
+    block_product = cache._block_product
+
+    def count(frame, position):
+        computed.append(position)
+        return block_product(frame, position)
+    cache._block_product = count
+
+    frames = np.random.rand(6, 2048).astype(np.float32)
+    with torch.no_grad():
+        for t in range(3):
+            history = frames[t:t + 4]
+            output = cache(history, np.arange(t, t + 4)).value
+            expected = layer(torch.from_numpy(history).t().reshape(-1))
+            assert torch.allclose(output, expected, atol=1e-3)
+        # One product per frame and position, the shifted frames only need their new block
+        assert computed == [0, 1, 2, 3] * 3
+
+        # Same history again: every product is cached
+        computed.clear()
+        cache(frames[2:6], np.arange(2, 6))
+        assert computed == []
+
+        # A frame without key is only multiplied by the block of its position
+        computed.clear()
+        cache(frames[2:6], np.array([2, 3, 4, -1]))
+        assert computed == [3]
+
+
+@pytest.mark.parametrize('method', ['word2vec', 'target_driven'])
+def test_factorize_low_rank_observation_layer(method):
+    torch.manual_seed(0)
+    dense = SharedNetwork(method, MASK_SIZE)
+    low_rank = SharedNetwork(method, MASK_SIZE, observation_rank=16)
+    low_rank.load_state_dict(factorize_observation_layer(dense.state_dict(), method, 16))
+
+    # A low-rank checkpoint is factorized again to a lower rank
+    compressed = SharedNetwork(method, MASK_SIZE, observation_rank=8)
+    compressed.load_state_dict(factorize_observation_layer(low_rank.state_dict(), method, 8))
+    reference = SharedNetwork(method, MASK_SIZE, observation_rank=8)
+    reference.load_state_dict(factorize_observation_layer(dense.state_dict(), method, 8))
+    layer = 'fc_siemense' if method == 'target_driven' else 'fc_observation'
+    with torch.no_grad():
+        weight = getattr(compressed.net, layer).weight
+        assert torch.allclose(weight, getattr(reference.net, layer).weight, atol=1e-4)
@@ -0,0 +1,91 @@
+import copy
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+from agent.network import MultiSceneNetwork, SceneSpecificNetwork, select_scene
+from agent.optim import SharedRMSprop
+
+SCENES = ['FloorPlan1', 'FloorPlan2', 'FloorPlan3']
+
+
+def scene_head(network, i):
+    """SceneSpecificNetwork with the weights of head i"""
+    head = SceneSpecificNetwork(9)
+    for name in ['fc1', 'fc2_policy', 'fc2_value']:
+        getattr(head, name).weight.data.copy_(getattr(network, name + '_weight')[i])
+        getattr(head, name).bias.data.copy_(getattr(network, name + '_bias')[i])
+    return head
+
+
+def test_mixed_batch_matches_heads():
+    torch.manual_seed(0)
+    network = MultiSceneNetwork(9, SCENES)
+    x = torch.rand(6, 512)
+    scene_ids = torch.tensor([0, 2, 2, 0, 2, 0])
+
+    (policy, value) = network((x, scene_ids))
+    for (k, i) in enumerate(scene_ids.tolist()):
+        (head_policy, head_value) = scene_head(network, i)(x[k])
+        assert torch.allclose(policy[k], head_policy, atol=1e-5)
+        assert torch.allclose(value[k], head_value, atol=1e-5)
+
+    select_scene(nn.Sequential(network), 'FloorPlan3')
+    (head_policy, head_value) = scene_head(network, 2)(x[0])
+    assert torch.allclose(network(x[0])[0], head_policy, atol=1e-5)
+
+
+def test_held_out_scene_uses_first_head():
+    torch.manual_seed(0)
+    network = MultiSceneNetwork(9, SCENES)
+    x = torch.rand(512)
+    with pytest.raises(Exception):
+        select_scene(network, 'FloorPlan4')
+
+    select_scene(network, 'FloorPlan3')
+    select_scene(network, 'FloorPlan4', fallback=True)
+    (head_policy, head_value) = scene_head(network, 0)(x)
+    (policy, value) = network(x)
+    assert torch.allclose(policy, head_policy, atol=1e-5)
+    assert torch.allclose(value, head_value, atol=1e-5)
+
+
+def test_unused_heads_have_no_gradient():
+    torch.manual_seed(0)
+    network = MultiSceneNetwork(9, SCENES)
+    (policy, value) = network((torch.rand(4, 512), torch.tensor([0, 2, 0, 2])))
+    (policy.sum() + value.sum()).backward()
+    assert network.fc1_weight[0].grad is not None
+    assert network.fc1_weight[2].grad is not None
+    assert network.fc1_weight[1].grad is None
+
+
+def test_optimizer_leaves_other_heads_untouched(monkeypatch):
+    # agent.training_thread reads the file descriptor of stdin on import
+    monkeypatch.setattr(sys, 'stdin', sys.__stdin__)
+    from agent.training import AnnealingLRScheduler, TrainingOptimizer
+
+    torch.manual_seed(0)
+    shared = MultiSceneNetwork(9, SCENES)
+    local = copy.deepcopy(shared)
+    rmsprop = SharedRMSprop(list(shared.parameters()), lr=1e-3)
+    optimizer = TrainingOptimizer(40.0, rmsprop, AnnealingLRScheduler(rmsprop, 100, 5))
+
+    def train(scene):
+        local.load_state_dict(shared.state_dict())
+        select_scene(local, scene)
+        (policy, value) = local(torch.rand(512))
+        optimizer.optimize(policy.sum() + value, local, shared, False)
+
+    train('FloorPlan1')
+    before = copy.deepcopy(shared.state_dict())
+    square_avg = rmsprop.state[shared.fc1_weight[0]]['square_avg'].clone()
+    for _ in range(3):
+        train('FloorPlan2')
+
+    # The head of FloorPlan1 and its RMSprop statistics did not change
+    assert torch.equal(shared.fc1_weight[0], before['fc1_weight.0'])
+    assert torch.equal(rmsprop.state[shared.fc1_weight[0]]['square_avg'], square_avg)
+    assert not torch.equal(shared.fc1_weight[1], before['fc1_weight.1'])
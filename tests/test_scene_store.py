@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from agent.environment.scene_store import SceneStore
+
+
+def test_saved_start_pools_must_match(tmp_path):
+    path = str(tmp_path / 'start_pools.npz')
+    store = SceneStore('{scene}.h5')
+    store.add_start_pool('FloorPlan1|soft_goal|Mug', np.array([1, 4, 7]))
+    store.save_start_pools(path)
+
+    # Same pools computed again
+    store = SceneStore('{scene}.h5')
+    store.add_start_pool('FloorPlan1|soft_goal|Mug', np.array([1, 4, 7]))
+    store.check_start_pools(path)
+
+    # Dataset changed since the pools were saved
+    store = SceneStore('{scene}.h5')
+    store.add_start_pool('FloorPlan1|soft_goal|Mug', np.array([1, 4, 8]))
+    with pytest.raises(Exception):
+        store.check_start_pools(path)